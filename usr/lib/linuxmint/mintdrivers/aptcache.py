@@ -0,0 +1,264 @@
+#!/usr/bin/python3
+
+import contextlib
+import glob
+import os
+import sys
+import threading
+import time
+
+import tracing
+
+APT_LISTS_DIR = "/var/lib/apt/lists"
+APT_ARCHIVES_DIR = "/var/cache/apt/archives"
+
+# Touched by APT every time the lists are updated, even when nothing changed
+# on the server side (in which case the list files themselves keep their old mtime)
+UPDATE_STAMPS = [APT_LISTS_DIR,
+                 os.path.join(APT_LISTS_DIR, "partial"),
+                 "/var/lib/apt/periodic/update-success-stamp"]
+
+def get_lists_age():
+    """ Return the number of seconds since the APT lists were last updated """
+    last_update = 0
+    for path in UPDATE_STAMPS:
+        try:
+            last_update = max(last_update, os.path.getmtime(path))
+        except OSError:
+            pass
+    return time.time() - last_update
+
+def get_driver_candidates(packages, devices):
+    """ Return the candidate versions of all the driver packages.
+        Used to find out whether a cache refresh changed anything for us. """
+    candidates = {}
+    for device in devices:
+        for pkg_name in devices[device]['drivers']:
+            pkg = packages.get(pkg_name)
+            if pkg is not None and pkg.candidate is not None:
+                candidates[pkg_name] = pkg.candidate.version
+            else:
+                candidates[pkg_name] = None
+    return candidates
+
+def get_archive_path(pkg_name, version, arch):
+    """ Where APT keeps the downloaded .deb of a package version """
+    return os.path.join(APT_ARCHIVES_DIR, "%s_%s_%s.deb" % (pkg_name, version.replace(":", "%3a"), arch))
+
+def forget_modalias_maps():
+    """ UbuntuDrivers memoizes the modalias map of each cache object, by hash(),
+        so it outlives a reopen of the same object """
+    detect = sys.modules.get("UbuntuDrivers.detect")
+    if detect is not None:
+        getattr(detect.packages_for_modalias, "cache_maps", {}).clear()
+
+def get_free_space(path):
+    try:
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+    except OSError:
+        return None
+
+def get_largest_initrd_size():
+    """ The initramfs images are regenerated when DKMS modules are built,
+        /boot needs room for a new one next to the old one """
+    sizes = [os.path.getsize(path) for path in glob.glob("/boot/initrd.img-*")]
+    return max(sizes) if len(sizes) > 0 else 0
+
+class DriverVersion:
+    """ The few bits of a package version we need to show and install drivers """
+
+    def __init__(self, records, pkg, ver):
+        self.version = ver.ver_str
+        self.package_id = "%s;%s;%s;" % (pkg.name, ver.ver_str, ver.arch)
+        self.size = ver.size
+        self.installed_size = ver.installed_size
+        self.summary = ""
+        if ver.translated_description is not None and records.lookup(ver.translated_description.file_list[0]):
+            self.summary = records.short_desc
+        self.dependencies = []
+        for dep_type in ("PreDepends", "Depends"):
+            for or_group in ver.depends_list.get(dep_type, []):
+                for dep in or_group:
+                    self.dependencies.append(dep.target_pkg.name)
+
+class DriverPackage:
+    """ A lightweight snapshot of a package, safe to use from the main loop
+        once the cache is gone or reopened """
+
+    def __init__(self, records, depcache, pkg):
+        self.shortname = pkg.name
+        self.installed = None
+        self.candidate = None
+        if pkg.current_ver is not None:
+            self.installed = DriverVersion(records, pkg, pkg.current_ver)
+        candidate = depcache.get_candidate_ver(pkg)
+        if candidate is not None:
+            self.candidate = DriverVersion(records, pkg, candidate)
+        self.is_installed = self.installed is not None
+
+    def get_dependencies(self):
+        version = self.candidate or self.installed
+        return version.dependencies if version is not None else []
+
+    def to_dict(self):
+        return {'shortname': self.shortname,
+                'installed': vars(self.installed) if self.installed is not None else None,
+                'candidate': vars(self.candidate) if self.candidate is not None else None}
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Rebuild a package from to_dict(), e.g. when it comes from the driver service """
+        pkg = cls.__new__(cls)
+        pkg.shortname = data['shortname']
+        pkg.installed = None
+        pkg.candidate = None
+        for key in ('installed', 'candidate'):
+            if data[key] is not None:
+                version = DriverVersion.__new__(DriverVersion)
+                vars(version).update(data[key])
+                setattr(pkg, key, version)
+        pkg.is_installed = pkg.installed is not None
+        return pkg
+
+class CacheManager:
+    """ Holds a single apt.Cache for the whole session, and a small view
+        of the packages related to the drivers, which is reloaded after
+        a transaction with a single reopen of the cache. """
+
+    def __init__(self):
+        self.cache = None
+        self.stale = False
+        self.lock = threading.Lock()
+        self.package_names = set()
+
+    def get_cache(self):
+        """ Return the full cache, opening it only the first time or when it's stale """
+        with self.lock:
+            return self._open()
+
+    @contextlib.contextmanager
+    def hold_cache(self):
+        """ Like get_cache(), but the cache can't be reopened by another thread until
+            the block exits. Use it for anything reading the cache for a while (detection). """
+        with self.lock:
+            yield self._open()
+
+    def invalidate(self):
+        """ The lists or the dpkg status changed, reopen the full cache next time it's needed """
+        with self.lock:
+            self.stale = True
+
+    def get_driver_packages(self, devices):
+        """ Return the view of the driver packages (and their dependencies) for these devices """
+        cache = self.get_cache()
+        with self.lock:
+            names = set()
+            for device in devices:
+                names.update(devices[device]['drivers'])
+            self.package_names = self._add_dependencies(cache, names)
+            with tracing.tracer.span("driver_packages", action="build") as span:
+                packages = self._snapshot(cache._cache, cache._depcache, cache._records, self.package_names)
+                span.set(packages=len(packages))
+            return packages
+
+    def get_packages(self, names):
+        """ Return the view of these packages (and their dependencies), without
+            changing the driver packages which get reloaded after a transaction """
+        cache = self.get_cache()
+        with self.lock:
+            package_names = self._add_dependencies(cache, names)
+            return self._snapshot(cache._cache, cache._depcache, cache._records, package_names)
+
+    def simulate(self, installs, removals):
+        """ Resolve the changes on a scratch depcache, the shared cache isn't touched.
+            Return the download size (without what's already in the APT archives),
+            the cached bytes, the installed size delta and the free disk space. """
+        import apt_pkg
+        cache = self.get_cache()
+        with self.lock, tracing.tracer.span("simulate", installs=installs, removals=removals) as span:
+            pkg_cache = cache._cache
+            depcache = apt_pkg.DepCache(pkg_cache)
+            resolver = apt_pkg.ProblemResolver(depcache)
+            with apt_pkg.ActionGroup(depcache):
+                for name in removals:
+                    pkg = pkg_cache[name]
+                    depcache.mark_delete(pkg, True)
+                    resolver.clear(pkg)
+                    resolver.protect(pkg)
+                    resolver.remove(pkg)
+                for name in installs:
+                    pkg = pkg_cache[name]
+                    depcache.mark_install(pkg)
+                    resolver.clear(pkg)
+                    resolver.protect(pkg)
+            broken = False
+            try:
+                resolver.resolve(True)
+            except SystemError:
+                broken = True
+            cached = 0
+            packages = 0
+            for pkg in pkg_cache.packages:
+                if depcache.marked_install(pkg) or depcache.marked_upgrade(pkg) or depcache.marked_downgrade(pkg):
+                    packages += 1
+                    version = depcache.get_candidate_ver(pkg)
+                    archive = get_archive_path(pkg.name, version.ver_str, version.arch)
+                    try:
+                        if os.path.getsize(archive) == version.size:
+                            cached += version.size
+                    except OSError:
+                        pass
+            simulation = {'packages': packages,
+                          'download': max(0, depcache.deb_size - cached),
+                          'cached': cached,
+                          'installed_delta': depcache.usr_size,
+                          'broken': broken or depcache.broken_count > 0,
+                          'root_free': get_free_space("/usr"),
+                          'boot_free': get_free_space("/boot"),
+                          'initrd_size': get_largest_initrd_size()}
+            span.set(**simulation)
+            return simulation
+
+    def reload_driver_packages(self):
+        """ Reopen the shared cache once after a transaction, and return the view
+            of the same driver packages. The next get_cache() doesn't reopen it again. """
+        with self.lock, tracing.tracer.span("driver_packages", action="reload") as span:
+            self.stale = True
+            cache = self._open()
+            packages = self._snapshot(cache._cache, cache._depcache, cache._records, self.package_names)
+            span.set(packages=len(packages))
+            return packages
+
+    def _open(self):
+        # Called with the lock held
+        if self.cache is None:
+            with tracing.tracer.span("apt_cache", action="open"):
+                import apt
+                self.cache = apt.Cache()
+        elif self.stale:
+            with tracing.tracer.span("apt_cache", action="reopen"):
+                self.cache.open()
+                forget_modalias_maps()
+        self.stale = False
+        return self.cache
+
+    def _add_dependencies(self, cache, names):
+        package_names = set(names)
+        for name in names:
+            if name in cache:
+                version = cache[name].candidate or cache[name].installed
+                if version is not None:
+                    package_names.update(dep.name for or_group in version.dependencies for dep in or_group)
+        return package_names
+
+    def _snapshot(self, pkg_cache, depcache, records, package_names):
+        packages = {}
+        for name in package_names:
+            try:
+                pkg = pkg_cache[name]
+            except KeyError:
+                continue
+            if pkg.has_versions:
+                packages[name] = DriverPackage(records, depcache, pkg)
+        return packages
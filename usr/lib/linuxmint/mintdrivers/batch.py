@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import aptcache
+import detection
+import drivers
+import tracing
+
+# Resolves the drivers of many saved hardware profiles (modalias dumps) in one go.
+# The APT cache and the modalias index of UbuntuDrivers are loaded once, in the
+# parent process, and shared by the forked workers.
+
+# Recycle the workers from time to time, to keep their memory bounded, in profiles
+PROFILES_PER_WORKER = 1000
+
+# Set in the parent before forking
+resolver = None
+
+class Resolver:
+
+    def __init__(self, cache_manager):
+        from UbuntuDrivers import detect
+        self.cache_manager = cache_manager
+        self.cache = cache_manager.get_cache()
+        # Only the packages seen so far, it can't grow bigger than the driver packages
+        self.driver_packages = {}
+        # Build the modalias index now, rather than in each worker
+        detect.packages_for_modalias(self.cache, "pci:")
+
+    def resolve(self, modaliases):
+        with tempfile.TemporaryDirectory() as sys_path:
+            detection.make_sys_tree(modaliases, sys_path)
+            devices = detection.system_device_drivers(apt_cache=self.cache, sys_path=sys_path)
+        # The devices are named after the temporary directory, use their place in the profile
+        # instead (e.g. devices/profile/0003), so that the same profile always gives the same report
+        devices = {os.path.relpath(path, sys_path): devices[path] for path in devices}
+        names = set()
+        for device in devices:
+            names.update(devices[device]['drivers'])
+        missing = names - self.driver_packages.keys()
+        if len(missing) > 0:
+            self.driver_packages.update(self.cache_manager.get_packages(missing))
+        return drivers.make_report(devices, self.driver_packages)
+
+def resolve_profile(path):
+    """ Runs in the workers, returns whether it failed and the report of a profile as a JSON line """
+    result = {'profile': path}
+    try:
+        modaliases = detection.load_profile(path)
+        # The detection is chatty
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            report = resolver.resolve(modaliases)
+        result['modaliases'] = len(modaliases)
+        result['recommended'] = sorted(set(entry['recommended'] for entry in report
+                                           if entry['recommended'] is not None and not entry['ignored']))
+        result['devices'] = report
+    except Exception as e:
+        result['error'] = str(e)
+    return ('error' in result, json.dumps(result))
+
+def get_profile_paths(paths):
+    """ Expand the directories into the profiles they contain """
+    profiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.isfile(os.path.join(path, name)):
+                    profiles.append(os.path.join(path, name))
+        else:
+            profiles.append(path)
+    return profiles
+
+def run(paths, jobs=None, output=sys.stdout):
+    """ Resolve the profiles and write a report per profile to the output, as JSON lines.
+        The reports are written as soon as they're ready (in order), nothing is kept in memory. """
+    global resolver
+    profiles = get_profile_paths(paths)
+    jobs = jobs or os.cpu_count() or 1
+    start = time.monotonic()
+    with tracing.tracer.span("batch", profiles=len(profiles), jobs=jobs) as span:
+        with contextlib.redirect_stdout(sys.stderr):
+            resolver = Resolver(aptcache.CacheManager())
+        errors = 0
+        # Fork, so that the workers share the cache and the index with the parent
+        context = multiprocessing.get_context("fork")
+        chunk_size = max(1, min(64, len(profiles) // (jobs * 4)))
+        # A task is a chunk of profiles
+        with context.Pool(jobs, maxtasksperchild=max(1, PROFILES_PER_WORKER // chunk_size)) as pool:
+            for (failed, line) in pool.imap(resolve_profile, profiles, chunk_size):
+                if failed:
+                    errors += 1
+                print(line, file=output)
+        span.set(errors=errors)
+    duration = time.monotonic() - start
+    print("Resolved %d profiles in %.1fs (%d errors)" % (len(profiles), duration, errors), file=sys.stderr)
+    return 1 if errors > 0 else 0
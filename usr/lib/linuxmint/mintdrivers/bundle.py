@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+
+import aptcache
+import tracing
+
+# An offline driver bundle is an uncompressed tar archive (the .deb files are
+# already compressed) containing a flat APT repository:
+#
+#   bundle.json     the manifest: what the bundle was made for, and the SHA256 of every file
+#   Packages        the index of the repository
+#   Packages.gz
+#   Release         the SHA256 of the indexes
+#   pool/*.deb
+#
+# It's imported into BUNDLE_DIR and added as an APT source, after all its files are verified.
+
+BUNDLE_VERSION = 1
+BUNDLE_DIR = "/var/lib/mintdrivers/bundle"
+SOURCE_FILE = "/etc/apt/sources.list.d/mintdrivers-bundle.list"
+
+# Present on every installation, no need to ship them
+BASE_PRIORITIES = ["required", "important"]
+
+class BundleError(Exception):
+    pass
+
+def get_sha256(path):
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+def is_safe_name(name):
+    """ Whether a file name from a bundle stays within the directory it's extracted to """
+    return not os.path.isabs(name) and ".." not in name.split("/")
+
+def fetch_deb(version, directory):
+    """ Copy the .deb from the APT archives if it's there and intact, download it otherwise """
+    archive = aptcache.get_archive_path(version.package.name, version.version, version.architecture)
+    target = os.path.join(directory, os.path.basename(version.filename))
+    try:
+        if os.path.getsize(archive) == version.size and version.sha256 and get_sha256(archive) == version.sha256:
+            shutil.copyfile(archive, target)
+            return target
+    except OSError:
+        pass
+    return version.fetch_binary(directory)
+
+def get_closure(cache, package_names):
+    """ Return the candidate versions of these packages and of all their dependencies,
+        except the ones which are part of any base system """
+    versions = {}
+    queue = list(package_names)
+    while len(queue) > 0:
+        name = queue.pop()
+        if name in versions or name not in cache:
+            continue
+        version = cache[name].candidate
+        if version is None:
+            continue
+        if version.priority in BASE_PRIORITIES and name not in package_names:
+            continue
+        versions[name] = version
+        for dependency in version.dependencies:
+            # The first alternative which can be satisfied (it also resolves virtual packages)
+            target_versions = dependency.target_versions
+            if len(target_versions) > 0:
+                queue.append(target_versions[0].package.name)
+    return versions
+
+def get_control(deb_path):
+    """ Return the control stanza of a .deb file """
+    return subprocess.check_output(["dpkg-deb", "--field", deb_path], text=True).strip()
+
+def write_index(directory, debs):
+    """ Write the Packages index and the Release file of a flat repository """
+    stanzas = []
+    for deb in sorted(debs):
+        path = os.path.join(directory, deb)
+        stanza = get_control(path)
+        stanza += "\nFilename: ./%s\nSize: %d\nSHA256: %s" % (deb, os.path.getsize(path), get_sha256(path))
+        stanzas.append(stanza)
+    index = "\n\n".join(stanzas) + "\n"
+    with open(os.path.join(directory, "Packages"), "w") as packages_file:
+        packages_file.write(index)
+    with gzip.open(os.path.join(directory, "Packages.gz"), "wt") as packages_file:
+        packages_file.write(index)
+    with open(os.path.join(directory, "Release"), "w") as release_file:
+        print("Origin: mintdrivers", file=release_file)
+        print("Label: mintdrivers offline bundle", file=release_file)
+        print("Date: %s" % time.strftime("%a, %d %b %Y %H:%M:%S UTC", time.gmtime()), file=release_file)
+        print("SHA256:", file=release_file)
+        for name in ("Packages", "Packages.gz"):
+            path = os.path.join(directory, name)
+            print(" %s %d %s" % (get_sha256(path), os.path.getsize(path), name), file=release_file)
+
+def export_bundle(path, cache, package_names, profiles, output):
+    """ Download the packages and their dependencies, and write them as a bundle """
+    with tracing.tracer.span("bundle", action="export") as span, tempfile.TemporaryDirectory() as directory:
+        versions = get_closure(cache, package_names)
+        print("Bundling %d packages: %s" % (len(versions), " ".join(sorted(versions))), file=output)
+        os.makedirs(os.path.join(directory, "pool"))
+        debs = []
+        for name in sorted(versions):
+            deb = fetch_deb(versions[name], os.path.join(directory, "pool"))
+            debs.append(os.path.relpath(deb, directory))
+        write_index(directory, debs)
+        files = {}
+        for name in ["Packages", "Packages.gz", "Release"] + debs:
+            files[name] = get_sha256(os.path.join(directory, name))
+        manifest = {'version': BUNDLE_VERSION,
+                    'created': int(time.time()),
+                    'architecture': subprocess.check_output(["dpkg", "--print-architecture"], text=True).strip(),
+                    'profiles': profiles,
+                    'drivers': sorted(package_names),
+                    'packages': sorted(versions),
+                    'files': files}
+        with open(os.path.join(directory, "bundle.json"), "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        with tarfile.open(path, "w") as archive:
+            # The manifest first, so that the import can read it before anything else
+            for name in ["bundle.json"] + sorted(files):
+                archive.add(os.path.join(directory, name), arcname=name, recursive=False)
+        size = os.path.getsize(path)
+        span.set(packages=len(versions), size=size)
+        print("Wrote %s (%d MB)" % (path, size // (1024 * 1024)), file=output)
+        return manifest
+
+def read_manifest(archive):
+    try:
+        member = archive.getmember("bundle.json")
+        manifest = json.load(archive.extractfile(member))
+    except (KeyError, ValueError):
+        raise BundleError("Not a driver bundle")
+    if manifest.get("version") != BUNDLE_VERSION:
+        raise BundleError("Unsupported bundle version: %s" % manifest.get("version"))
+    for name in manifest.get("files", {}):
+        if not is_safe_name(name):
+            raise BundleError("Invalid file name in the bundle: %s" % name)
+    return manifest
+
+def extract_bundle(path, directory=BUNDLE_DIR):
+    """ Extract and verify the bundle, nothing is left behind if it's invalid """
+    with tracing.tracer.span("bundle", action="import") as span, tarfile.open(path, "r") as archive:
+        manifest = read_manifest(archive)
+        files = manifest['files']
+        staging = directory + ".new"
+        shutil.rmtree(staging, ignore_errors=True)
+        try:
+            for member in archive:
+                if member.name == "bundle.json":
+                    continue
+                # Only extract the files listed in the manifest, as regular files, within the staging directory
+                if member.name not in files or not member.isfile() or not is_safe_name(member.name):
+                    raise BundleError("Unexpected file in the bundle: %s" % member.name)
+                target = os.path.join(staging, member.name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                checksum = hashlib.sha256()
+                with archive.extractfile(member) as source, open(target, "wb") as destination:
+                    for block in iter(lambda: source.read(1024 * 1024), b""):
+                        checksum.update(block)
+                        destination.write(block)
+                if checksum.hexdigest() != files[member.name]:
+                    raise BundleError("Checksum mismatch: %s" % member.name)
+            missing = [name for name in files if not os.path.exists(os.path.join(staging, name))]
+            if len(missing) > 0:
+                raise BundleError("Missing files in the bundle: %s" % " ".join(missing))
+            with open(os.path.join(staging, "bundle.json"), "w") as manifest_file:
+                json.dump(manifest, manifest_file, indent=2)
+        except:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(staging, directory)
+        span.set(packages=len(manifest['packages']))
+        return manifest
+
+def import_bundle(path, output, directory=BUNDLE_DIR):
+    """ Extract the bundle and add it as an APT source. Only this source is indexed. """
+    manifest = extract_bundle(path, directory)
+    print("Imported %d packages in %s" % (len(manifest['packages']), directory), file=output)
+    with open(SOURCE_FILE, "w") as source_file:
+        print("deb [trusted=yes] file://%s ./" % directory, file=source_file)
+    return subprocess.call(["apt-get", "-y", "update",
+                            "-o", "Dir::Etc::sourcelist=%s" % SOURCE_FILE,
+                            "-o", "Dir::Etc::sourceparts=-",
+                            "-o", "APT::Get::List-Cleanup=0"], stdout=output)
+
+def remove_bundle(directory=BUNDLE_DIR):
+    shutil.rmtree(directory, ignore_errors=True)
+    try:
+        os.remove(SOURCE_FILE)
+    except OSError:
+        pass
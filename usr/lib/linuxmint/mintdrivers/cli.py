@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+import aptcache
+import batch
+import bundle
+import detection
+import drivers
+from drivers import _
+
+# The headless front-end of the driver manager.
+# It shares the detection and recommendation logic with the GUI, but never loads Gtk.
+
+def get_report(use_cache=True, use_service=False):
+    """ Detect the devices and return a report about their drivers """
+    # Keep stdout clean for the report, the detection is chatty
+    with contextlib.redirect_stdout(sys.stderr):
+        if use_service:
+            import service
+            from gi.repository import GLib
+            try:
+                (devices, driver_packages, report) = service.get_state()
+                return (report, driver_packages)
+            except GLib.Error as e:
+                print("Could not reach the driver service: %s" % e.message)
+        cache_manager = aptcache.CacheManager()
+        devices = detection.system_device_drivers(apt_cache=cache_manager.get_cache(), use_cache=use_cache)
+        driver_packages = cache_manager.get_driver_packages(devices)
+        report = drivers.make_report(devices, driver_packages)
+    return (report, driver_packages)
+
+def print_report(report):
+    for entry in report:
+        print(entry['name'])
+        print("  %s: %s" % (_("Device"), entry['device']))
+        print("  %s: %s" % (_("Status"), entry['status']))
+        if entry['ignored']:
+            print("  %s" % _("Ignored"))
+        for driver in entry['drivers']:
+            flags = []
+            if driver['recommended']:
+                flags.append(_("recommended"))
+            if driver['installed']:
+                flags.append(_("installed"))
+            if driver['builtin']:
+                flags.append(_("builtin"))
+            marker = "*" if driver['selected'] else " "
+            print("  %s %s %s %s" % (marker, driver['package'], driver['version'], " ".join("(%s)" % flag for flag in flags)))
+        print()
+
+def get_recommended_changes(report, driver_packages):
+    """ Return the packages to install and to remove to switch every device to its recommended driver.
+        Same as the GUI, the builtin drivers are never installed nor removed. """
+    installs = []
+    removals = []
+    for entry in report:
+        if entry['ignored'] or entry['recommended'] is None or entry['selected'] == entry['recommended']:
+            continue
+        builtins = [driver['package'] for driver in entry['drivers'] if driver['builtin']]
+        if entry['recommended'] not in builtins:
+            installs.append(entry['recommended'])
+        selected = entry['selected']
+        if selected is not None and selected not in builtins and driver_packages[selected].is_installed:
+            removals.append(selected)
+            # Same as the GUI, the NVIDIA package is a metapackage
+            if 'nvidia' in selected:
+                for dep in drivers.get_dependencies(driver_packages, selected, 'nvidia'):
+                    dep_pkg = driver_packages.get(dep)
+                    if dep_pkg is not None and dep_pkg.is_installed and dep not in removals:
+                        removals.append(dep)
+    return (installs, removals)
+
+def apply_changes(installs, removals, dry_run=False, output=sys.stdout):
+    if len(installs) == 0 and len(removals) == 0:
+        print(_("All the devices are using their recommended drivers."), file=output)
+        return 0
+    if len(removals) > 0:
+        # apt-get purge installs the packages suffixed with '+'
+        command = ["apt-get", "-y", "purge"] + removals + ["%s+" % pkg for pkg in installs]
+    else:
+        command = ["apt-get", "-y", "install"] + installs
+    if dry_run:
+        command.insert(1, "--simulate")
+    print(" ".join(command), file=output)
+    return subprocess.call(command, stdout=output)
+
+def export_bundle(path, profiles, use_cache=True, output=sys.stdout):
+    """ Bundle the recommended drivers of this computer, or of the given modalias profiles """
+    with contextlib.redirect_stdout(sys.stderr):
+        cache_manager = aptcache.CacheManager()
+        cache = cache_manager.get_cache()
+        package_names = set()
+        for profile in profiles or [None]:
+            if profile is None:
+                devices = detection.system_device_drivers(apt_cache=cache, use_cache=use_cache)
+            else:
+                with tempfile.TemporaryDirectory() as sys_path:
+                    detection.make_sys_tree(detection.load_profile(profile), sys_path)
+                    devices = detection.system_device_drivers(apt_cache=cache, sys_path=sys_path)
+            report = drivers.make_report(devices, cache_manager.get_driver_packages(devices))
+            for entry in report:
+                if not entry['ignored'] and entry['recommended'] is not None:
+                    package_names.add(entry['recommended'])
+        if len(package_names) == 0:
+            print(_("No drivers to bundle."), file=output)
+            return 1
+        bundle.export_bundle(path, cache, sorted(package_names), profiles, output)
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(prog="mintdrivers", description=_("Driver Manager"))
+    parser.add_argument("--list", action="store_true", help="list the devices and their drivers")
+    parser.add_argument("--json", action="store_true", help="use JSON as the output format")
+    parser.add_argument("--apply-recommended", action="store_true", help="switch all the devices to their recommended drivers")
+    parser.add_argument("--dry-run", action="store_true", help="only simulate the changes")
+    parser.add_argument("--no-cache", action="store_true", help="don't use the cached driver detection")
+    parser.add_argument("--service", action="store_true", help="get the drivers from the driver service")
+    parser.add_argument("--export-bundle", metavar="FILE", help="write the recommended drivers and their dependencies to an offline bundle")
+    parser.add_argument("--profile", metavar="FILE", action="append", help="bundle the drivers for these modaliases (one per line) instead of this computer's")
+    parser.add_argument("--import-bundle", metavar="FILE", help="add an offline bundle as a package source")
+    parser.add_argument("--remove-bundle", action="store_true", help="remove the imported offline bundle")
+    parser.add_argument("--batch", metavar="PROFILE", nargs="+", help="report the recommended drivers for saved modalias profiles (files or directories), as JSON lines")
+    parser.add_argument("--jobs", type=int, help="number of processes used by --batch (default: number of CPUs)")
+    args = parser.parse_args()
+
+    if not (args.list or args.apply_recommended or args.batch or args.export_bundle or args.import_bundle or args.remove_bundle):
+        parser.error("nothing to do, use --list or --apply-recommended")
+
+    if args.apply_recommended and os.getuid() != 0 and not args.dry_run:
+        print("mintdrivers --apply-recommended needs to be run as root.")
+        return 1
+
+    if (args.import_bundle or args.remove_bundle) and os.getuid() != 0:
+        print("mintdrivers --import-bundle and --remove-bundle need to be run as root.")
+        return 1
+
+    if args.batch:
+        return batch.run(args.batch, jobs=args.jobs)
+
+    if args.export_bundle:
+        return export_bundle(args.export_bundle, args.profile, use_cache=not args.no_cache)
+
+    if args.remove_bundle:
+        bundle.remove_bundle()
+        return 0
+
+    if args.import_bundle:
+        try:
+            return bundle.import_bundle(args.import_bundle, output=sys.stdout)
+        except (bundle.BundleError, OSError, tarfile.TarError) as e:
+            print("Could not import %s: %s" % (args.import_bundle, e))
+            return 1
+
+    (report, driver_packages) = get_report(use_cache=not args.no_cache, use_service=args.service)
+
+    if args.apply_recommended:
+        (installs, removals) = get_recommended_changes(report, driver_packages)
+        if args.json:
+            # Keep stdout for the JSON output
+            print(json.dumps({'install': installs, 'remove': removals}, indent=2))
+            sys.stdout.flush()
+            return apply_changes(installs, removals, args.dry_run, output=sys.stderr)
+        return apply_changes(installs, removals, args.dry_run)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
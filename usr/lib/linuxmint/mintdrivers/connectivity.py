@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+
+import glob
+import select
+import socket
+import threading
+import time
+import urllib.parse
+
+# Always probed, even if it's not configured in APT
+FALLBACK_HOSTS = [("archive.ubuntu.com", 443)]
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+def get_source_uris():
+    """ Return the URIs of all the APT sources (one-line and deb822 formats) """
+    uris = []
+    paths = ["/etc/apt/sources.list"] + sorted(glob.glob("/etc/apt/sources.list.d/*.list"))
+    for path in paths:
+        try:
+            with open(path) as source_file:
+                for line in source_file:
+                    line = line.split("#")[0].strip()
+                    if not line.startswith("deb"):
+                        continue
+                    # Skip the [options] part if present
+                    if "]" in line:
+                        line = line.split("]", 1)[1]
+                    else:
+                        line = line.split(None, 1)[1] if len(line.split()) > 1 else ""
+                    elements = line.split()
+                    if len(elements) > 0:
+                        uris.append(elements[0])
+        except OSError:
+            pass
+    for path in sorted(glob.glob("/etc/apt/sources.list.d/*.sources")):
+        try:
+            with open(path) as source_file:
+                for line in source_file:
+                    if line.lower().startswith("uris:"):
+                        uris += line.split(":", 1)[1].split()
+        except OSError:
+            pass
+    return uris
+
+def get_mirror_hosts():
+    """ Return the (host, port) of all the network mirrors configured in APT """
+    hosts = []
+    for uri in get_source_uris():
+        parsed = urllib.parse.urlparse(uri)
+        scheme = parsed.scheme.replace("mirror+", "")
+        if scheme not in DEFAULT_PORTS or parsed.hostname is None:
+            continue
+        try:
+            host = (parsed.hostname, parsed.port or DEFAULT_PORTS[scheme])
+        except ValueError:
+            continue
+        if host not in hosts:
+            hosts.append(host)
+    for host in FALLBACK_HOSTS:
+        if host not in hosts:
+            hosts.append(host)
+    return hosts
+
+def probe_host(host, port, deadline, done):
+    """ Try to connect to host:port until the deadline.
+        Gives up as soon as the done event is set (another probe succeeded). """
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError:
+        return False
+    for (family, socktype, proto, canonname, address) in addresses:
+        if done.is_set():
+            return False
+        try:
+            sock = socket.socket(family, socktype, proto)
+        except OSError:
+            continue
+        try:
+            sock.setblocking(False)
+            sock.connect_ex(address)
+            while not done.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                # Poll in small slices so that we can be cancelled
+                (readable, writable, errors) = select.select([], [sock], [], min(remaining, 0.1))
+                if writable:
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                        return True
+                    break
+        except OSError:
+            pass
+        finally:
+            sock.close()
+    return False
+
+def is_online(hosts=None, timeout=10):
+    """ Probe all the hosts concurrently, the first one to answer wins
+        and the remaining probes are cancelled. """
+    if hosts is None:
+        hosts = get_mirror_hosts()
+    if len(hosts) == 0:
+        return False
+    deadline = time.monotonic() + timeout
+    done = threading.Event()
+    lock = threading.Lock()
+    results = []
+
+    def probe(host, port):
+        success = probe_host(host, port, deadline, done)
+        with lock:
+            results.append(success)
+            if success:
+                print ("  --> %s:%d is reachable" % (host, port))
+            if success or len(results) == len(hosts):
+                done.set()
+
+    for (host, port) in hosts:
+        thread = threading.Thread(target=probe, args=(host, port))
+        thread.daemon = True
+        thread.start()
+    done.wait(timeout)
+    done.set()
+    with lock:
+        return any(results)
+
+def find_live_media():
+    """ Return the device and mount point of the first iso9660 partition """
+    import psutil
+    for partition in psutil.disk_partitions():
+        if partition.fstype == "iso9660":
+            return (partition.device, partition.mountpoint)
+    return None
+
+def check(timeout=10):
+    """ Look for the Internet and for a live media at the same time.
+        Returns a tuple (online, live_media). """
+    live_media = []
+    scan = threading.Thread(target=lambda: live_media.append(find_live_media()))
+    scan.daemon = True
+    scan.start()
+    online = is_online(timeout=timeout)
+    if online:
+        # The scan result isn't needed
+        return (True, None)
+    scan.join()
+    return (False, live_media[0] if live_media else None)
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+import hashlib
+import json
+import os
+import tempfile
+
+import tracing
+
+CACHE_VERSION = 1
+
+# Anything which can change the result of the detection
+FINGERPRINT_PATHS = ["/var/lib/apt/lists",
+                     "/var/lib/dpkg/status",
+                     "/etc/apt/preferences.d",
+                     "/usr/share/ubuntu-drivers-common/detect"]
+
+def get_cache_path():
+    if os.getuid() == 0:
+        cache_dir = "/var/cache/mintdrivers"
+    else:
+        cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "mintdrivers")
+    return os.path.join(cache_dir, "detection.json")
+
+def get_modaliases(sys_path="/sys"):
+    """ Return the sorted list of modaliases exposed in sysfs """
+    modaliases = set()
+    for (path, dirs, files) in os.walk(os.path.join(sys_path, "devices")):
+        if "modalias" in files:
+            try:
+                with open(os.path.join(path, "modalias")) as modalias_file:
+                    modaliases.add(modalias_file.read().strip())
+            except OSError:
+                pass
+    return sorted(modaliases)
+
+def get_loaded_modules():
+    """ Used to detect manually installed drivers """
+    modules = []
+    try:
+        with open("/proc/modules") as modules_file:
+            for line in modules_file:
+                modules.append(line.split()[0])
+    except OSError:
+        pass
+    return sorted(modules)
+
+def get_fingerprint(sys_path="/sys"):
+    """ Hash the hardware, the kernel, the loaded modules and the package lists """
+    fingerprint = hashlib.sha256()
+    fingerprint.update(os.uname().release.encode())
+    for modalias in get_modaliases(sys_path):
+        fingerprint.update(modalias.encode() + b"\n")
+    for module in get_loaded_modules():
+        fingerprint.update(module.encode() + b"\n")
+    for path in FINGERPRINT_PATHS:
+        try:
+            fingerprint.update(("%s %d\n" % (path, os.stat(path).st_mtime_ns)).encode())
+        except OSError:
+            fingerprint.update(("%s missing\n" % path).encode())
+    return fingerprint.hexdigest()
+
+def load_cached_devices(fingerprint):
+    try:
+        with open(get_cache_path()) as cache_file:
+            data = json.load(cache_file)
+        if data.get("version") == CACHE_VERSION and data.get("fingerprint") == fingerprint:
+            return data["devices"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+    return None
+
+def save_cached_devices(fingerprint, devices):
+    path = get_cache_path()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so that a concurrent reader never sees a partial file
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), delete=False) as cache_file:
+            json.dump({"version": CACHE_VERSION, "fingerprint": fingerprint, "devices": devices}, cache_file)
+        os.replace(cache_file.name, path)
+    except (OSError, TypeError, ValueError) as e:
+        print("Could not save the detection cache: %s" % e)
+
+def clear_cache():
+    """ Drop the stored detection, e.g. with --no-cache """
+    try:
+        os.remove(get_cache_path())
+    except OSError:
+        pass
+
+def load_profile(path):
+    """ Load a list of modaliases, one per line (e.g. the output of cat /sys/bus/*/devices/*/modalias) """
+    modaliases = []
+    with open(path) as profile_file:
+        for line in profile_file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                modaliases.append(line)
+    return modaliases
+
+def make_sys_tree(modaliases, directory):
+    """ Write a fake sysfs tree exposing these modaliases, for the detection to resolve them """
+    for (index, modalias) in enumerate(modaliases):
+        device_dir = os.path.join(directory, "devices", "profile", "%04d" % index)
+        os.makedirs(device_dir, exist_ok=True)
+        with open(os.path.join(device_dir, "modalias"), "w") as modalias_file:
+            modalias_file.write(modalias + "\n")
+    return directory
+
+def system_device_drivers(apt_cache=None, use_cache=True, sys_path=None):
+    """ Same as UbuntuDrivers.detect.system_device_drivers(), but the result is cached
+        on disk and reused as long as the hardware and the packages don't change.
+        The cache is only used for the real hardware, not for another sys_path. """
+    if not use_cache and sys_path is None:
+        # Asked for a fresh detection, the stored one can't be trusted anymore
+        clear_cache()
+    use_cache = use_cache and sys_path is None
+    with tracing.tracer.span("detection", cached=False) as span:
+        if use_cache:
+            fingerprint = get_fingerprint()
+            devices = load_cached_devices(fingerprint)
+            if devices is not None:
+                print("Using cached driver detection")
+                span.set(cached=True, devices=len(devices))
+                return devices
+        from UbuntuDrivers import detect
+        devices = detect.system_device_drivers(apt_cache=apt_cache, sys_path=sys_path)
+        if use_cache:
+            save_cached_devices(fingerprint, devices)
+        span.set(devices=len(devices))
+        return devices
+
+def detect_device(apt_cache, modalias):
+    """ Detect the drivers of a single device (e.g. one which was just plugged in),
+        without scanning the others. Return None if it doesn't need any driver. """
+    with tempfile.TemporaryDirectory() as sys_path:
+        make_sys_tree([modalias], sys_path)
+        devices = system_device_drivers(apt_cache=apt_cache, sys_path=sys_path)
+    for device in devices.values():
+        return device
+    return None
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+import glob
+import os
+import re
+import time
+
+DKMS_DIR = "/var/lib/dkms"
+MODULES_DIR = "/lib/modules"
+
+# First line of make.log, e.g. "DKMS make.log for nvidia-550.54.14 for kernel 6.8.0-31-generic (x86_64)"
+KERNEL_PATTERN = re.compile(r"for kernel (\S+)")
+# An object compiled by kbuild, e.g. "  CC [M]  /var/lib/dkms/nvidia/550.54.14/build/nvidia/nv.o"
+OBJECT_PATTERN = re.compile(r"^\s*CC \[M\]", re.MULTILINE)
+
+def get_kernels():
+    """ Return the kernels DKMS builds modules for, the ones with headers """
+    try:
+        kernels = os.listdir(MODULES_DIR)
+    except OSError:
+        return []
+    return sorted(kernel for kernel in kernels if os.path.exists(os.path.join(MODULES_DIR, kernel, "build")))
+
+def get_version_key(kernel):
+    # "6.10.0-1-generic" comes after "6.8.0-31-generic"
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", kernel)]
+
+def get_priority_kernels(kernels):
+    """ Return the kernels DKMS builds for when autoinstall_all_kernels is off:
+        the running kernel, and the newest one, which is the one booted by default """
+    priority = []
+    running = os.uname().release
+    if running in kernels:
+        priority.append(running)
+    if len(kernels) > 0:
+        newest = max(kernels, key=get_version_key)
+        if newest not in priority:
+            priority.append(newest)
+    return priority
+
+class DkmsBuild:
+
+    def __init__(self, path, module, version, kernel, index):
+        self.path = path
+        self.module = module
+        self.version = version
+        self.kernel = kernel
+        # Position among the builds of this module in the transaction, starting at 1
+        self.index = index
+        self.start = time.monotonic()
+        self.updated = self.start
+        self.objects = 0
+        self.offset = 0
+
+    def read(self):
+        """ Count the objects compiled since the last read """
+        try:
+            with open(self.path, errors="replace") as log:
+                if os.fstat(log.fileno()).st_size < self.offset:
+                    self.offset = 0
+                    self.objects = 0
+                log.seek(self.offset)
+                self.objects += len(OBJECT_PATTERN.findall(log.read()))
+                self.offset = log.tell()
+        except OSError:
+            pass
+        self.updated = time.monotonic()
+
+    def get_elapsed(self):
+        return self.updated - self.start
+
+class DkmsMonitor:
+    """ Follows the DKMS builds of a transaction, by tailing the make.log in the build
+        directory of each module (/var/lib/dkms/<module>/<version>/build/make.log).
+        A build is over when its make.log goes away (DKMS moves it next to the built
+        module) or when the next kernel starts. """
+
+    def __init__(self, dkms_dir=DKMS_DIR):
+        self.dkms_dir = dkms_dir
+        # Leftovers of previous failed builds aren't ours
+        self.started = time.time()
+        self.builds = {}
+        self.kernels = {}
+        self.finished = []
+
+    def poll(self):
+        """ Return the builds in progress. The finished ones are added to self.finished. """
+        seen = set()
+        for path in glob.glob(os.path.join(self.dkms_dir, "*", "*", "build", "make.log")):
+            try:
+                if os.path.getmtime(path) < self.started:
+                    continue
+                with open(path, errors="replace") as log:
+                    match = KERNEL_PATTERN.search(log.readline())
+            except OSError:
+                continue
+            if match is None:
+                continue
+            kernel = match.group(1)
+            build = self.builds.get(path)
+            if build is not None and build.kernel != kernel:
+                self.finished.append(build)
+                build = None
+            if build is None:
+                (module, version) = path.split(os.sep)[-4:-2]
+                kernels = self.kernels.setdefault(module, [])
+                kernels.append(kernel)
+                build = DkmsBuild(path, module, version, kernel, len(kernels))
+                self.builds[path] = build
+            build.read()
+            seen.add(path)
+        for path in list(self.builds.keys()):
+            if path not in seen:
+                self.finished.append(self.builds.pop(path))
+        return list(self.builds.values())
+
+    def stop(self):
+        """ The transaction is over, so are the builds """
+        self.finished.extend(self.builds.values())
+        self.builds = {}
+
+    def pop_finished(self):
+        finished = self.finished
+        self.finished = []
+        return finished
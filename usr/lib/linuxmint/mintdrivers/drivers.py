@@ -0,0 +1,353 @@
+#!/usr/bin/python3
+
+import gettext
+import locale
+import os
+
+import tracing
+
+APP = 'mintdrivers'
+LOCALE_DIR = "/usr/share/locale"
+locale.bindtextdomain(APP, LOCALE_DIR)
+gettext.bindtextdomain(APP, LOCALE_DIR)
+gettext.textdomain(APP)
+_ = gettext.gettext
+
+DPKG_STATUS = "/var/lib/dpkg/status"
+
+# The driver recommendation engine, shared by the GUI and the command line.
+# Nothing in here should import Gtk.
+
+def get_dependencies(driver_packages, package_name, pattern=None):
+    """ Get the package dependencies, which can be filtered out by a pattern """
+    dependencies = driver_packages[package_name].get_dependencies()
+    if pattern:
+      dependencies = [ x for x in dependencies if x.find(pattern) != -1 ]
+    return dependencies
+
+def get_download_size(driver_packages, package_name):
+    """ Estimate the download size of a package, including its direct dependencies which aren't installed """
+    pkg = driver_packages[package_name]
+    size = pkg.candidate.size
+    for dep in pkg.get_dependencies():
+        dep_pkg = driver_packages.get(dep)
+        if dep_pkg is not None and not dep_pkg.is_installed and dep_pkg.candidate is not None:
+            size += dep_pkg.candidate.size
+    return size
+
+# Since 560, open-source drivers are recommended by the NVIDIA devs
+NVIDIA_OPEN_PREFERRED_BRANCH = 560
+
+class NvidiaDriver:
+    """ The family, branch, flavor and server flag of an NVIDIA driver package,
+        e.g. nvidia-driver-550-server-open is ("nvidia-driver", 550, "open", True) """
+
+    def __init__(self, pkg_name):
+        self.name = pkg_name
+        name = pkg_name
+        self.flavor = "closed"
+        if name.endswith("-open"):
+            self.flavor = "open"
+            name = name[:-len("-open")]
+        self.server = name.endswith("-server")
+        if self.server:
+            name = name[:-len("-server")]
+        (family, separator, branch) = name.rpartition("-")
+        if separator and branch.isdigit():
+            self.family = family
+            self.branch = int(branch)
+        else:
+            self.family = name
+            self.branch = None
+
+class DriverCatalog:
+    """ The NVIDIA drivers of a device, indexed by (family, branch, server flag) and flavor.
+        The ignored drivers are resolved once, when the catalog is built. """
+
+    def __init__(self, device):
+        self.flavors = {}
+        for pkg_name in device['drivers']:
+            if pkg_name.startswith("nvidia-"):
+                driver = NvidiaDriver(pkg_name)
+                self.flavors.setdefault((driver.family, driver.branch, driver.server), {})[driver.flavor] = pkg_name
+        self.ignored = set()
+        self._find_ignored(device)
+
+    def get_preferred_flavor(self, family, branch):
+        if family == "nvidia-driver" and branch is not None and branch >= NVIDIA_OPEN_PREFERRED_BRANCH:
+            return "open"
+        return "closed"
+
+    def is_ignored(self, pkg_name):
+        return pkg_name in self.ignored
+
+    def _find_ignored(self, device):
+        """
+        - Never show server drivers.
+        - Pre 560: closed source drivers are recommended. Override any recommended -open drivers with the closed
+          source equivalent.
+        - Post 560 (02/13/2025: open-source drivers are recommended by their devs, and closed source drivers may
+          not be available for a given version.
+        """
+        for ((family, branch, server), flavors) in self.flavors.items():
+            if server:
+                for pkg_name in flavors.values():
+                    print("Ignoring server NVIDIA driver '%s'" % pkg_name)
+                    self.ignored.add(pkg_name)
+                continue
+            if "open" not in flavors or "closed" not in flavors:
+                continue
+            (open_name, closed_name) = (flavors["open"], flavors["closed"])
+            if self.get_preferred_flavor(family, branch) == "open":
+                print("Ignoring closed NVIDIA driver '%s' as the open one is preferred." % closed_name)
+                self.ignored.add(closed_name)
+            else:
+                print("Ignoring open NVIDIA driver '%s' as a closed one exists and is preferred." % open_name)
+                open_driver = device['drivers'][open_name]
+                if open_driver.get("recommended", False) and open_driver.get("from_distro", False):
+                    device['drivers'][closed_name]["recommended"] = True
+                self.ignored.add(open_name)
+
+def get_device_data(device, driver_packages):
+    """Get the drivers of a device and their status.
+
+      return a tuple of (overall_status, drivers dict).
+      overall_status is the section of the selected driver.
+      the drivers dict is using this form:
+        {"recommended/alternative": {pkg_name: {
+                                                  'selected': True/False
+                                                  'description': 'description'
+                                                  'builtin': True/False,
+                                                  'free': True/False,
+                                                  'installed': True/False,
+                                                  'version': 'version'
+                                                }
+                                     }}
+         "manually_installed": {"manual": {'selected': True, 'description': description_string}}
+         "no_driver": {"no_driver": {'selected': True/False, 'description': description_string}}
+
+         Please note that either manually_installed and no_driver are set to None if not applicable
+         (no_driver isn't present if there are builtins)
+    """
+
+    returned_drivers = {'recommended': {}, 'alternative': {}, 'manually_installed': {}, 'no_driver': {}}
+    have_builtin = False
+    one_selected = False
+    try:
+        if device['manual_install']:
+            returned_drivers['manually_installed'] = {True: {'selected': True,
+                                                             'description': _("Continue using a manually installed driver")}}
+    except KeyError:
+        pass
+
+    catalog = DriverCatalog(device)
+
+    for pkg_driver_name in device['drivers']:
+        if catalog.is_ignored(pkg_driver_name):
+            continue
+        current_driver = device['drivers'][pkg_driver_name]
+
+        # get general status
+        driver_status = 'alternative'
+        try:
+            if (current_driver['recommended'] and current_driver['from_distro']):
+                driver_status = 'recommended'
+        except KeyError:
+            pass
+
+        builtin = False
+        try:
+            if current_driver['builtin']:
+                builtin = True
+                have_builtin = True
+        except KeyError:
+            pass
+
+        try:
+            pkg = driver_packages[pkg_driver_name]
+            installed = pkg.is_installed
+            if installed:
+                version = pkg.installed.version
+                summary = pkg.installed.summary
+            else:
+                version = pkg.candidate.version
+                summary = pkg.candidate.summary
+            description_line1 = "<b>%s</b>" % pkg.shortname
+            description_line2 = "<small>%s</small> %s" % (_("Version"), version)
+            description_line3 = "<small>%s</small>" % summary
+            if driver_status == 'recommended':
+                description_line1 = "%s <b><small><span foreground='#58822B'>(%s)</span></small></b>" % (description_line1, _("recommended"))
+            if current_driver['free'] and pkg.shortname != "broadcom-sta-dkms" and (not pkg.shortname.startswith("nvidia-")):
+                description_line1 = "%s <b><small><span foreground='#717bbd'>(%s)</span></small></b>" % (description_line1, _("open-source"))
+            if pkg.shortname.startswith("firmware-b43"):
+                # B43 requires a connection to the Internet
+                description_line1 = "%s <b><small><span foreground='#9f5258'>(%s)</span></small></b>" % (description_line1, _("requires a connection to the Internet"))
+            description = "%s\n%s\n%s" % (description_line1, description_line2, description_line3)
+        except KeyError:
+            print("WARNING: a driver ({}) doesn't have any available package associated: {}".format(pkg_driver_name, current_driver))
+            continue
+
+        selected = False
+        if not builtin and not returned_drivers['manually_installed']:
+            selected = installed
+            if installed:
+                selected = True
+                one_selected = True
+
+        returned_drivers[driver_status].setdefault(pkg_driver_name, {'selected': selected,
+                                                                     'description': description,
+                                                                     'builtin': builtin,
+                                                                     'free': current_driver['free'],
+                                                                     'installed': installed,
+                                                                     'version': version})
+
+    # adjust making the needed addition
+    if not have_builtin:
+        selected = False
+        if not one_selected:
+            selected = True
+        returned_drivers["no_driver"] = {True: {'selected': selected,
+                                                'description': _("Do not use the device")}}
+    else:
+        # we have a builtin and no selection: builtin is the selected one then
+        if not one_selected:
+            for section in ('recommended', 'alternative'):
+                for pkg_name in returned_drivers[section]:
+                    if returned_drivers[section][pkg_name]['builtin']:
+                        returned_drivers[section][pkg_name]['selected'] = True
+
+    # compute overall status
+    overall_status = 'no_driver'
+    for section in returned_drivers:
+        for keys in returned_drivers[section]:
+            if returned_drivers[section][keys]['selected']:
+                overall_status = section
+
+    return overall_status, returned_drivers
+
+class DeviceDataCache:
+    """ Memoizes get_device_data(), per device and per state of its driver packages.
+        Everything is dropped when the dpkg status changes. """
+
+    def __init__(self):
+        self.results = {}
+        self.dpkg_mtime = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_key(self, device, driver_packages):
+        key = [device.get('modalias')]
+        for pkg_name in sorted(device['drivers']):
+            driver = device['drivers'][pkg_name]
+            key.append((pkg_name, driver.get('recommended'), driver.get('from_distro'), driver.get('free'), driver.get('builtin')))
+            pkg = driver_packages.get(pkg_name)
+            if pkg is not None:
+                key.append((pkg.installed.version if pkg.installed else None,
+                            pkg.candidate.version if pkg.candidate else None))
+        key.append(device.get('manual_install'))
+        return tuple(key)
+
+    def get_device_data(self, device, driver_packages):
+        try:
+            dpkg_mtime = os.stat(DPKG_STATUS).st_mtime_ns
+        except OSError:
+            dpkg_mtime = None
+        if dpkg_mtime != self.dpkg_mtime:
+            self.results = {}
+            self.dpkg_mtime = dpkg_mtime
+        result = self.results.get(self.get_key(device, driver_packages))
+        if result is not None:
+            self.hits += 1
+            tracing.tracer.count("device_data_hits")
+            return result
+        self.misses += 1
+        tracing.tracer.count("device_data_misses")
+        result = get_device_data(device, driver_packages)
+        # The NVIDIA filtering can tweak the device, so compute the key afterwards
+        self.results[self.get_key(device, driver_packages)] = result
+        return result
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.results)}
+
+def sort_string(drivers, x):
+    value = x
+    try:
+        value = "%s %s" % (not drivers[x]['free'], value)
+    except:
+        pass #best effort (some driver options don't have a 'free' flag, and that's alright)
+    return value
+
+def is_cpu(device):
+    return "intel-microcode" in device['drivers'] or "amd64-microcode" in device['drivers']
+
+def get_device_name(device):
+    model_name = device.get('model', None)
+    vendor_name = device.get('vendor', None)
+    if vendor_name is None and model_name is None:
+        return _("Unknown")
+    elif vendor_name is None:
+        return model_name
+    elif model_name is None:
+        return vendor_name
+    return "%s: %s" % (vendor_name, model_name)
+
+def is_virtual_device(device_name):
+    return "vmware" in device_name.lower() or "virtualbox" in device_name.lower()
+
+def count_proprietary_drivers(devices, driver_packages):
+    count = 0
+    for device in devices:
+        for pkg_name in devices[device]['drivers']:
+            pkg = driver_packages.get(pkg_name)
+            if pkg is None:
+                continue
+            if (not devices[device]['drivers'][pkg_name]['free'] or pkg_name == "broadcom-sta-dkms") and pkg.is_installed:
+                count = count + 1
+    return count
+
+def get_recommendation(device, driver_packages):
+    """ Return a summary of the device status: its recommended and selected drivers """
+    (overall_status, drivers) = get_device_data(device, driver_packages)
+    recommended = None
+    selected = None
+    for section in ('recommended', 'alternative'):
+        for pkg_name in sorted(drivers[section], key=lambda x: sort_string(drivers[section], x), reverse=True):
+            if section == 'recommended' and recommended is None:
+                recommended = pkg_name
+            if drivers[section][pkg_name]['selected']:
+                selected = pkg_name
+    return {'status': overall_status,
+            'recommended': recommended,
+            'selected': selected,
+            'manually_installed': bool(drivers['manually_installed']),
+            'drivers': drivers}
+
+def make_report(devices, driver_packages):
+    """ Return a report about the drivers of these devices """
+    report = []
+    for device in sorted(devices.keys()):
+        data = get_recommendation(devices[device], driver_packages)
+        device_name = get_device_name(devices[device])
+        entry = {'device': device,
+                 'name': device_name,
+                 'vendor': devices[device].get('vendor'),
+                 'model': devices[device].get('model'),
+                 'modalias': devices[device].get('modalias'),
+                 'status': data['status'],
+                 'recommended': data['recommended'],
+                 'selected': data['selected'],
+                 'ignored': is_virtual_device(device_name) or data['manually_installed'],
+                 'drivers': []}
+        for section in ('recommended', 'alternative'):
+            for pkg_name in sorted(data['drivers'][section]):
+                driver = data['drivers'][section][pkg_name]
+                entry['drivers'].append({'package': pkg_name,
+                                         'version': driver['version'],
+                                         'installed': driver['installed'],
+                                         'selected': driver['selected'],
+                                         'recommended': section == 'recommended',
+                                         'free': driver['free'],
+                                         'builtin': driver['builtin']})
+        report.append(entry)
+    return report
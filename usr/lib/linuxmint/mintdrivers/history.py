@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+import json
+import os
+import time
+
+# Used when there's no history yet, in bytes per second
+DEFAULT_DOWNLOAD_RATE = 2 * 1024 * 1024
+DEFAULT_INSTALL_RATE = 10 * 1024 * 1024
+# Only the latest transactions are relevant (network, disk..)
+MAX_RECORDS = 20
+MAX_BUILD_RECORDS = 100
+
+def get_history_path():
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "mintdrivers", "history.json")
+
+class TransactionHistory:
+    """ Remembers how fast the previous transactions downloaded and installed their packages,
+        to estimate how long the next one will take, and how long the DKMS builds took. """
+
+    def __init__(self):
+        self.records = []
+        self.builds = []
+        try:
+            with open(get_history_path()) as history_file:
+                data = json.load(history_file)
+            self.records = data.get("transactions", [])
+            self.builds = data.get("builds", [])
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def record(self, download_bytes, download_seconds, installed_bytes, install_seconds):
+        self.records.append({'download_bytes': download_bytes, 'download_seconds': download_seconds,
+                             'installed_bytes': installed_bytes, 'install_seconds': install_seconds})
+        self.records = self.records[-MAX_RECORDS:]
+        self.save()
+
+    def record_build(self, module, version, kernel, seconds, objects):
+        self.builds.append({'module': module, 'version': version, 'kernel': kernel,
+                            'seconds': round(seconds, 1), 'objects': objects, 'time': int(time.time())})
+        self.builds = self.builds[-MAX_BUILD_RECORDS:]
+        self.save()
+
+    def get_build_objects(self, module):
+        """ Return the number of objects the latest complete build of this module compiled, if any """
+        for build in reversed(self.builds):
+            if build['module'] == module and build['objects'] > 0:
+                return build['objects']
+        return None
+
+    def save(self):
+        path = get_history_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as history_file:
+                json.dump({'transactions': self.records, 'builds': self.builds}, history_file)
+        except OSError as e:
+            print("Could not save the transaction history: %s" % e)
+
+    def get_rate(self, size_key, seconds_key, default):
+        size = sum(record[size_key] for record in self.records if record[seconds_key] > 0)
+        seconds = sum(record[seconds_key] for record in self.records if record[seconds_key] > 0)
+        if size <= 0 or seconds <= 0:
+            return default
+        return size / seconds
+
+    def estimate(self, download_bytes, installed_bytes):
+        """ Return the estimated duration of a transaction, in seconds """
+        download_rate = self.get_rate('download_bytes', 'download_seconds', DEFAULT_DOWNLOAD_RATE)
+        install_rate = self.get_rate('installed_bytes', 'install_seconds', DEFAULT_INSTALL_RATE)
+        return download_bytes / download_rate + installed_bytes / install_rate
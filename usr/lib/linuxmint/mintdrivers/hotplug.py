@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+import socket
+
+import gi
+from gi.repository import GLib
+
+# The buses drivers are found for
+MONITORED_SUBSYSTEMS = ["pci", "usb", "sdio", "pcmcia", "bcma", "ssb"]
+
+NETLINK_KOBJECT_UEVENT = 15
+# Multicast group of the uevents sent by the kernel (udev rebroadcasts them in group 2)
+KERNEL_UEVENT_GROUP = 1
+
+def parse_uevent(data):
+    """ Parse a kernel uevent ("action@devpath\\0KEY=value\\0...") into a dictionary """
+    properties = {}
+    for field in data.split(b"\0")[1:]:
+        (key, separator, value) = field.partition(b"=")
+        if separator:
+            properties[key.decode(errors="replace")] = value.decode(errors="replace")
+    return properties
+
+class DeviceMonitor:
+    """ Reports the devices which are plugged in or removed, by calling
+        callback(action, device_path, modalias) from the main loop, with
+        action being "add" or "remove" and device_path the sysfs path.
+        Uses GUdev when it's available, and listens to the kernel uevents otherwise. """
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.client = None
+        self.socket = None
+        try:
+            gi.require_version("GUdev", "1.0")
+            from gi.repository import GUdev
+            self.client = GUdev.Client.new(MONITORED_SUBSYSTEMS)
+            self.client.connect("uevent", self.on_udev_event)
+        except (ImportError, ValueError):
+            self.watch_uevents()
+
+    def on_udev_event(self, client, action, device):
+        self.report(action, device.get_subsystem(), device.get_sysfs_path(), device.get_property("MODALIAS"))
+
+    def watch_uevents(self):
+        try:
+            self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            self.socket.bind((0, KERNEL_UEVENT_GROUP))
+        except (OSError, AttributeError) as e:
+            print("Could not monitor the devices: %s" % e)
+            self.socket = None
+            return
+        GLib.io_add_watch(self.socket.fileno(), GLib.PRIORITY_DEFAULT, GLib.IOCondition.IN, self.on_uevent)
+
+    def on_uevent(self, fd, condition):
+        try:
+            data = self.socket.recv(65536)
+        except OSError:
+            return True
+        properties = parse_uevent(data)
+        if "DEVPATH" in properties:
+            self.report(properties.get("ACTION"), properties.get("SUBSYSTEM"), "/sys" + properties["DEVPATH"], properties.get("MODALIAS"))
+        return True
+
+    def report(self, action, subsystem, device_path, modalias):
+        if action in ("add", "remove") and subsystem in MONITORED_SUBSYSTEMS:
+            self.callback(action, device_path, modalias)
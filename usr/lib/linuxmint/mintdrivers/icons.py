@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import threading
+import gi
+gi.require_version("GdkPixbuf", "2.0")
+from gi.repository import GdkPixbuf, GLib
+
+ICONS_DIR = "/usr/share/linuxmint/mintdrivers/icons"
+
+def get_icon_name(device):
+    vendor = device.get('vendor', 'Unknown')
+    model = device.get('model', 'Unknown')
+    icon = "generic"
+    if "nvidia" in vendor.lower():
+        icon = "nvidia"
+    elif "radeon" in vendor.lower() or "radeon" in model.lower() or "Advanced Micro Devices" in vendor or "AMD" in vendor or "ATI" in vendor:
+        icon = "ati"
+    elif "broadcom" in vendor.lower():
+        icon = "broadcom"
+    elif "virtualbox" in vendor.lower() or "virtualbox" in model.lower():
+        icon = "virtualbox"
+
+    if "intel-microcode" in device['drivers']:
+        icon = "intel"
+    elif "amd64-microcode" in device['drivers']:
+        icon = "amd"
+
+    return icon
+
+class IconCache:
+    """ Rasterizes the vendor icons once per process, and keeps PNG renders
+        in the user's cache, so that librsvg is rarely needed at all. """
+
+    def __init__(self):
+        self.pixbufs = {}
+        self.lock = threading.Lock()
+        self.cache_dir = os.path.join(GLib.get_user_cache_dir(), "mintdrivers", "icons")
+
+    def get_pixbuf(self, name, size, scale=1):
+        key = (name, size, scale)
+        with self.lock:
+            if key in self.pixbufs:
+                return self.pixbufs[key]
+        pixbuf = self.load(name, size * scale)
+        with self.lock:
+            self.pixbufs[key] = pixbuf
+        return pixbuf
+
+    def load(self, name, size):
+        svg_path = os.path.join(ICONS_DIR, "%s.svg" % name)
+        try:
+            mtime = int(os.path.getmtime(svg_path))
+        except OSError:
+            mtime = 0
+        png_path = os.path.join(self.cache_dir, "%s-%d-%d.png" % (name, size, mtime))
+        try:
+            return GdkPixbuf.Pixbuf.new_from_file(png_path)
+        except GLib.Error:
+            pass
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(svg_path, size, -1)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            (fd, tmp_path) = tempfile.mkstemp(dir=self.cache_dir, suffix=".png")
+            os.close(fd)
+            pixbuf.savev(tmp_path, "png", [], [])
+            os.replace(tmp_path, png_path)
+        except (OSError, GLib.Error) as e:
+            print("Could not cache icon %s: %s" % (name, e))
+        return pixbuf
+
+    def preload(self, names, size, scale=1):
+        """ Load the icons ahead of time, call this from a worker thread """
+        for name in names:
+            try:
+                self.get_pixbuf(name, size, scale)
+            except GLib.Error as e:
+                print("Could not load icon %s: %s" % (name, e))
+
+cache = IconCache()
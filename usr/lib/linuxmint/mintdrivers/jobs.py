@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+import threading
+import traceback
+
+from gi.repository import Gio, GLib
+
+class Job:
+
+    def __init__(self, name, function, callback, args):
+        self.name = name
+        self.function = function
+        self.callback = callback
+        self.args = args
+        self.superseded = False
+
+class JobScheduler:
+    """ Runs the heavy work (detection, connectivity check, live media..) in background threads.
+
+        - Only one job of each type runs at a time. Submitting the same job again while
+          it's running does nothing. Submitting it with other arguments (or with restart=True,
+          when the running one is outdated) queues it until the running one is done.
+        - The jobs share a Gio.Cancellable, which is cancelled when quitting. They get it
+          as their first argument and should check it between their phases.
+        - A job returns the arguments of its callback, or None to skip it. The callbacks
+          are all called from the main loop, in dispatch(). """
+
+    def __init__(self):
+        self.cancellable = Gio.Cancellable()
+        self.lock = threading.Lock()
+        self.running = {}
+        self.pending = {}
+
+    def submit(self, name, function, callback, *args, restart=False):
+        job = Job(name, function, callback, args)
+        with self.lock:
+            if self.cancellable.is_cancelled():
+                return
+            running = self.running.get(name)
+            if running is None:
+                self.running[name] = job
+            elif restart:
+                print("Restarting the '%s' job" % name)
+                running.superseded = True
+                self.pending[name] = job
+                return
+            elif running.args == args and name not in self.pending:
+                print("The '%s' job is already running" % name)
+                return
+            else:
+                self.pending[name] = job
+                return
+        self.start(job)
+
+    def is_running(self, name):
+        with self.lock:
+            return name in self.running
+
+    def cancel(self):
+        """ Cancel everything. The running jobs are left to die with the process, their results are dropped. """
+        with self.lock:
+            self.pending = {}
+            self.cancellable.cancel()
+
+    def start(self, job):
+        thread = threading.Thread(target=self.run, args=(job,))
+        thread.daemon = True
+        thread.start()
+
+    def run(self, job):
+        result = None
+        try:
+            result = job.function(self.cancellable, *job.args)
+        except Exception:
+            print("The '%s' job failed" % job.name)
+            traceback.print_exc()
+        GLib.idle_add(self.dispatch, job, result)
+
+    def dispatch(self, job, result):
+        with self.lock:
+            del self.running[job.name]
+            next_job = self.pending.pop(job.name, None)
+            if next_job is not None:
+                self.running[job.name] = next_job
+            cancelled = self.cancellable.is_cancelled()
+        if next_job is not None:
+            self.start(next_job)
+        if result is not None and not cancelled and not job.superseded:
+            job.callback(*result)
+        return False
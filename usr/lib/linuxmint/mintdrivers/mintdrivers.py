@@ -1,24 +1,33 @@
 #! /usr/bin/python3
 # -*- coding=utf-8 -*-
 
+# Imported first, so that the startup trace includes the other imports
+import tracing
+import argparse
 import gettext
 import locale
 import os
-import sys
-import apt
 import subprocess
+import sys
 import gi
 gi.require_version("GdkPixbuf", "2.0")
 gi.require_version("Gtk", "3.0")
 gi.require_version("XApp", "1.0")
 gi.require_version("PackageKitGlib", "1.0")
-from gi.repository import GdkPixbuf, Gtk, XApp, Gio, GLib
-from gi.repository import PackageKitGlib as packagekit
-from UbuntuDrivers import detect
-import psutil
+from gi.repository import Gtk, Gio, GLib
 import re
-import socket
 import threading
+import time
+
+import aptcache
+import connectivity
+import detection
+import dkms
+import drivers
+import history
+import hotplug
+import jobs
+import progress
 
 # Used as a decorator to run things in the background
 def _async(func):
@@ -35,6 +44,11 @@ def idle(func):
         GLib.idle_add(func, *args)
     return wrapper
 
+APPLY_CHANGES_HELPER = "/usr/bin/mintdrivers-apply-changes"
+DEVICE_ICON_SIZE = 48
+# How often the DKMS build logs are checked during a transaction, in milliseconds
+DKMS_POLL_INTERVAL = 500
+
 APP = 'mintdrivers'
 LOCALE_DIR = "/usr/share/locale"
 locale.bindtextdomain(APP, LOCALE_DIR)
@@ -42,29 +56,34 @@ gettext.bindtextdomain(APP, LOCALE_DIR)
 gettext.textdomain(APP)
 _ = gettext.gettext
 
+tracing.startup.phase("imports")
+
 class Application:
 
-    def __init__(self):
+    def __init__(self, args):
 
+        self.use_detection_cache = not args.no_cache
         self.test_mode = False
-        if len(sys.argv) > 1 and sys.argv[1] == "test":
+        if args.mode == "test":
             self.test_mode = True
             print("Test mode detected, adding a dummy device.")
 
+        self.settings = Gio.Settings(schema_id="com.linuxmint.drivers")
+        # The dummy device isn't known to the service
+        self.use_service = self.settings.get_boolean("use-service") and not self.test_mode
+        self.service_refresh = False
+
         self.builder = Gtk.Builder()
         self.builder.set_translation_domain(APP)
         self.builder.add_from_file("/usr/share/linuxmint/mintdrivers/main.ui")
         self.builder.connect_signals(self)
-        for o in self.builder.get_objects():
-            if issubclass(type(o), Gtk.Buildable):
-                name = Gtk.Buildable.get_name(o)
-                setattr(self, name, o)
-            else:
-                print("can not get name for object '%s'" % o)
-
-        self.window_main.show()
+        tracing.startup.phase("builder")
 
         self.window_main.set_title(_("Driver Manager"))
+        self.show_page("refresh_page")
+        self.window_main.connect("draw", self.on_window_drawn)
+        self.window_main.show()
+        self.scale_factor = self.window_main.get_scale_factor()
 
         self.window_main.connect("delete_event", self.quit_application)
 
@@ -98,17 +117,62 @@ class Application:
         self.needs_restart = False
         self.needs_broadcom_reload = False
         self.live_mode = False
-
-        self.show_page("refresh_page")
-
+        self.devices = None
+        self.driver_packages = {}
+        self.driver_changes = set()
+        self.driver_candidates = None
+        self.cache_manager = aptcache.CacheManager()
+        self.cache_refreshed = False
+        self.jobs = jobs.JobScheduler()
+        self.prefetch_cancellable = None
+        self.prefetch_package_ids = []
+        self.device_rows = {}
+        self.device_monitor = None
+        self.no_drv = []
+        self.device_data_cache = drivers.DeviceDataCache()
+        self.cpu_name = None
+        self.transaction_span = tracing.NullSpan()
+        self.transaction_status = None
+        self.transaction_status_span = tracing.NullSpan()
+        self.transaction_progress = progress.ProgressAggregator(self.render_driver_changes_progress)
+        self.transaction_history = history.TransactionHistory()
+        self.transaction_times = {}
+        self.transaction_status_start = None
+        self.dkms_monitor = None
+        self.dkms_source_id = None
+        self.dkms_kernels = []
+        self.simulation = None
+        self.applied_simulation = None
+        self.refresh_span = tracing.NullSpan()
+
+        tracing.startup.phase("window setup")
+        # Let the window paint before starting anything
+        GLib.idle_add(self.start)
+
+    def __getattr__(self, name):
+        # Builder objects are looked up the first time they're used
+        builder = self.__dict__.get("builder")
+        obj = builder.get_object(name) if builder is not None else None
+        if obj is None:
+            raise AttributeError(name)
+        setattr(self, name, obj)
+        return obj
+
+    def on_window_drawn(self, widget, cr):
+        self.window_main.disconnect_by_func(self.on_window_drawn)
+        tracing.startup.phase("window painted")
+        return False
+
+    def start(self):
         with open('/proc/cmdline') as f:
             cmdline = f.read()
             if ("boot=casper" in cmdline) or ("boot=live" in cmdline):
                 print ("Live mode detected")
                 self.live_mode = True
-                self.update_cache()
+                self.update_cache(force=True)
             else:
                 self.check_internet_or_live_media()
+        return False
 
     def show_page(self, page):
         if page == "refresh_page":
@@ -120,13 +184,31 @@ class Application:
     def on_error_button(self, button):
         self.show_page("drivers_page")
 
-    def update_cache(self):
-        print("Updating cache")
+    def update_cache(self, force=False):
+        from gi.repository import PackageKitGlib as packagekit
         self.show_page("refresh_page")
         task = packagekit.Task()
-        task.refresh_cache_async(True, Gio.Cancellable(), self.on_cache_update_progress, (None, ), self.on_cache_update_finished, (None, ))
+        if force:
+            # Refresh the cache before showing the drivers
+            print("Updating cache")
+            self.refresh_span = tracing.tracer.span("refresh_cache", force=True)
+            task.refresh_cache_async(True, self.jobs.cancellable, self.on_cache_update_progress, (None, ), self.on_cache_update_finished, (None, ))
+            return
+
+        # Show the drivers straight away from the current cache
+        self.get_drivers_async()
+        age = aptcache.get_lists_age()
+        ttl = self.settings.get_int("cache-ttl") * 60
+        if age < ttl:
+            print("Cache is fresh (updated %d minutes ago), not refreshing it" % (age // 60))
+            return
+        # Let APT decide what needs to be downloaded (If-Modified-Since, pdiffs)
+        print("Updating cache in the background")
+        self.refresh_span = tracing.tracer.span("refresh_cache", force=False)
+        task.refresh_cache_async(False, self.jobs.cancellable, self.on_cache_update_progress, (None, ), self.on_background_cache_update_finished, (None, ))
 
     def on_error(self, error):
+        from gi.repository import PackageKitGlib as packagekit
         # Returns False if the error was from cancelling or failing to authenticate.
         # This will bring the ui back to pre-apply state. Returning True will reset
         # entirely.
@@ -148,51 +230,72 @@ class Application:
         pass
 
     def on_cache_update_finished(self, source, result, data=None):
+        from gi.repository import XApp
         print("Cache updated")
+        self.refresh_span.finish()
+        tracing.startup.phase("cache refresh")
         XApp.set_window_progress(self.window_main, 0)
-        self.get_drivers_async()
+        self.cache_manager.invalidate()
+        self.service_refresh = True
+        self.get_drivers_async(restart=True)
+
+    def on_background_cache_update_finished(self, source, result, data=None):
+        try:
+            source.generic_finish(result)
+        except GLib.Error as e:
+            print("Background cache update failed: %s" % e.message)
+            self.refresh_span.finish(error=e.message)
+            return
+        print("Cache updated")
+        self.refresh_span.finish()
+        self.cache_manager.invalidate()
+        self.service_refresh = True
+        self.get_drivers_async(refreshed=True)
 
     def quit_application(self, widget=None, event=None):
+        self.jobs.cancel()
+        self.cancel_prefetch()
         self.cleanup_live_media()
         Gtk.main_quit()
 
     def cleanup_live_media(self):
         subprocess.call(["sudo", "mintdrivers-remove-live-media"])
 
-    @idle
     def check_internet_or_live_media(self, widget=None):
         self.show_page("refresh_page")
-        print ("Checking Internet connectivity...")
-        try:
-            socket.create_connection(("archive.ubuntu.com", 443), timeout=10)
+        self.check_connectivity_async()
+
+    def check_connectivity_async(self):
+        self.jobs.submit("connectivity", self.check_connectivity, self.on_connectivity_checked)
+
+    def check_connectivity(self, cancellable):
+        print ("Checking Internet connectivity and looking for a live media...")
+        with tracing.tracer.span("connectivity") as span:
+            (online, live_media) = connectivity.check()
+            span.set(online=online, live_media=live_media is not None)
+        tracing.startup.phase("connectivity")
+        return (online, live_media)
+
+    def on_connectivity_checked(self, online, live_media):
+        if online:
             # We're online
             print ("  --> Computer is online")
             self.update_cache()
             return
-        except:
-            print ("  --> Computer is offline")
-
-        # We're offline, let's look for a live media
-        print ("Checking for a live media...")
-        mount_point = None
-        partitions = psutil.disk_partitions()
-        for p in partitions:
-            if p.fstype == "iso9660":
-                mount_point = p.mountpoint
-                print ("  --> Found: %s at %s" % (p.device, p.mountpoint))
-                break
-
-        if mount_point is None:
+        print ("  --> Computer is offline")
+
+        if live_media is None:
             # Offline and no live media, show the offline page
-            print ("  --> None found.")
+            print ("  --> No live media found.")
             self.show_page("offline_page")
             return
 
         # We're offline but an ISO was detected
         # Let's make sure it's mounted as a repository
+        print ("  --> Found: %s at %s" % live_media)
         if os.path.exists("/media/mintdrivers/.disk/info"):
             print ("  --> Mounted in /media/mintdrivers")
-            self.update_cache()
+            self.update_cache(force=True)
         else:
             print ("  --> Not mounted in /media/mintdrivers")
             self.show_page("media_page")
@@ -202,41 +305,162 @@ class Application:
         self.show_page("refresh_page")
         self.mount_live_media()
 
-    @_async
     def mount_live_media(self):
-        subprocess.call(["/usr/bin/pkexec", "mintdrivers-add-live-media"])
-        self.check_internet_or_live_media()
+        self.jobs.submit("live_media", self.add_live_media, self.on_live_media_mounted)
+
+    def add_live_media(self, cancellable):
+        return (subprocess.call(["/usr/bin/pkexec", "mintdrivers-add-live-media"]), )
+
+    def on_live_media_mounted(self, return_code):
+        if return_code != 0:
+            # Not added (or the authentication was dismissed), check again
+            self.check_connectivity_async()
+            return
+        # The helper only indexed the live media, the other lists are unchanged
+        # and refreshing them while offline would only time out.
+        print ("  --> Live media added and indexed")
+        self.cache_manager.invalidate()
+        self.service_refresh = True
+        self.get_drivers_async(restart=True)
 
     def on_driver_changes_progress(self, progress, ptype, data=None):
-        self.button_driver_revert.set_visible(False)
-        self.button_driver_apply.set_visible(False)
-        self.button_driver_restart.set_visible(False)
-        self.button_driver_cancel.set_visible(True)
-        self.progress_bar.set_visible(True)
-        self.progress_bar.set_visible(True)
-
-        if progress.get_status() == packagekit.StatusEnum.DOWNLOAD:
-            self.label_driver_action.set_label(_("Downloading drivers..."))
-        elif progress.get_status() == packagekit.StatusEnum.INSTALL:
-            self.label_driver_action.set_label(_("Installing drivers..."))
-        elif progress.get_status() == packagekit.StatusEnum.REMOVE:
-            self.label_driver_action.set_label(_("Removing drivers..."))
-        elif progress.get_status() == packagekit.StatusEnum.CANCEL:
-            self.label_driver_action.set_label(_("Cancelling..."))
-        elif progress.get_status() == packagekit.StatusEnum.LOADING_CACHE:
-            self.label_driver_action.set_label(_("Loading cache..."))
-        else:
-            self.label_driver_action.set_label("")
-        if ptype == packagekit.ProgressType.PERCENTAGE:
-            prog_value = progress.get_property('percentage')
-            self.progress_bar.set_fraction(prog_value / 100.0)
-            XApp.set_window_progress(self.window_main, prog_value)
+        from gi.repository import PackageKitGlib as packagekit
+        # Called for every change, only record it. It's rendered by the aggregator.
+        if ptype == packagekit.ProgressType.STATUS:
+            statuses = {packagekit.StatusEnum.DOWNLOAD: "download",
+                        packagekit.StatusEnum.INSTALL: "install",
+                        packagekit.StatusEnum.REMOVE: "remove",
+                        packagekit.StatusEnum.CANCEL: "cancel",
+                        packagekit.StatusEnum.LOADING_CACHE: "loading-cache"}
+            self.show_driver_changes_progress(statuses.get(progress.get_status()))
+        elif ptype == packagekit.ProgressType.PERCENTAGE:
+            self.transaction_progress.set_percentage(progress.get_property('percentage'))
+        elif ptype == packagekit.ProgressType.DOWNLOAD_SIZE_REMAINING:
+            self.transaction_progress.set_remaining(progress.get_property('download-size-remaining'))
+
+    def show_driver_changes_progress(self, status, percentage=None):
+        if status != self.transaction_status:
+            # Time each phase of the transaction
+            self.account_transaction_time()
+            tracing.tracer.count("transaction_status_changes")
+            self.transaction_status_span.finish()
+            self.transaction_status = status
+            self.transaction_status_span = tracing.tracer.span("transaction_status", status=status)
+        self.transaction_progress.set_status(status)
+        if percentage is not None:
+            self.transaction_progress.set_percentage(percentage)
+
+    def render_driver_changes_progress(self, state, changed, first):
+        from gi.repository import XApp
+        if first:
+            self.button_driver_revert.set_visible(False)
+            self.button_driver_apply.set_visible(False)
+            self.button_driver_restart.set_visible(False)
+            self.button_driver_cancel.set_visible(True)
+            self.progress_bar.set_visible(True)
+
+        build = state['build']
+        if build is not None:
+            # DKMS compiles the module from the postinst, PackageKit only says it's installing
+            if changed & {'status', 'build'}:
+                (module, kernel, index, total, elapsed, percentage) = build
+                label = _("Building the %(module)s module for kernel %(kernel)s (%(index)d/%(total)d), %(elapsed)s elapsed") % \
+                    {'module': module, 'kernel': kernel, 'index': index, 'total': max(index, total), 'elapsed': progress.format_eta(elapsed)}
+                self.label_driver_action.set_label(label)
+                if percentage is not None:
+                    self.progress_bar.set_fraction(percentage / 100.0)
+                else:
+                    self.progress_bar.pulse()
+            return
+        if changed & {'status', 'speed', 'eta', 'build'}:
+            status = state['status']
+            if status == "download":
+                label = _("Downloading drivers...")
+                if state['speed'] is not None:
+                    label = "%s %s/s" % (label, GLib.format_size(int(state['speed'])))
+                if state['eta'] is not None:
+                    label = "%s, %s" % (label, _("%s remaining") % progress.format_eta(state['eta']))
+            elif status == "install":
+                label = _("Installing drivers...")
+            elif status == "remove":
+                label = _("Removing drivers...")
+            elif status == "cancel":
+                label = _("Cancelling...")
+            elif status == "loading-cache":
+                label = _("Loading cache...")
+            else:
+                label = ""
+            self.label_driver_action.set_label(label)
+        if changed & {'percentage', 'build'} and state['percentage'] is not None:
+            self.progress_bar.set_fraction(state['percentage'] / 100.0)
+            XApp.set_window_progress(self.window_main, state['percentage'])
+
+    def start_transaction_trace(self, kind, packages, **fields):
+        self.account_transaction_time()
+        self.transaction_span = tracing.tracer.span("transaction", kind=kind, packages=packages, **fields)
+        self.transaction_status = None
+        self.transaction_status_span = tracing.tracer.span("transaction_status")
+        self.transaction_progress.reset()
+
+    def finish_transaction_trace(self, **fields):
+        # Drop any pending render, the transaction is over
+        self.transaction_progress.reset()
+        self.transaction_status_span.finish()
+        self.transaction_span.finish(**fields)
+
+    def start_dkms_monitor(self, fast=False):
+        self.stop_dkms_monitor()
+        self.dkms_monitor = dkms.DkmsMonitor()
+        self.dkms_kernels = dkms.get_kernels()
+        if fast:
+            # The other kernels are built in the background once the transaction is done
+            self.dkms_kernels = dkms.get_priority_kernels(self.dkms_kernels)
+        self.dkms_source_id = GLib.timeout_add(DKMS_POLL_INTERVAL, self.on_dkms_poll)
+
+    def stop_dkms_monitor(self):
+        if self.dkms_monitor is None:
+            return
+        GLib.source_remove(self.dkms_source_id)
+        self.dkms_source_id = None
+        self.dkms_monitor.poll()
+        self.dkms_monitor.stop()
+        self.record_dkms_builds()
+        self.dkms_monitor = None
+
+    def on_dkms_poll(self):
+        builds = self.dkms_monitor.poll()
+        self.record_dkms_builds()
+        if len(builds) == 0:
+            if self.transaction_progress.state['build'] is not None:
+                # Nothing to render otherwise
+                self.transaction_progress.set_build(None)
+            return True
+        build = builds[0]
+        percentage = None
+        objects = self.transaction_history.get_build_objects(build.module)
+        if objects is not None:
+            # Compared to the previous build, it's never quite done until DKMS says so
+            percentage = min(99, build.objects * 100 // objects)
+        self.transaction_progress.set_build((build.module, build.kernel, build.index, len(self.dkms_kernels),
+                                             int(build.get_elapsed()), percentage))
+        return True
+
+    def record_dkms_builds(self):
+        for build in self.dkms_monitor.pop_finished():
+            elapsed = build.get_elapsed()
+            print("Built the %s module for kernel %s in %.1fs" % (build.module, build.kernel, elapsed))
+            tracing.tracer.emit("dkms_build", module=build.module, version=build.version, kernel=build.kernel,
+                                duration_ms=round(elapsed * 1000, 1), objects=build.objects)
+            self.transaction_history.record_build(build.module, build.version, build.kernel, elapsed, build.objects)
+            self.transaction_times["dkms"] = self.transaction_times.get("dkms", 0) + elapsed
 
     def on_driver_changes_finish(self, source, result, installs):
         errors = False
         try:
             self.pk_task.generic_finish(result)
+            self.finish_transaction_trace(success=True)
         except GLib.Error as e:
+            self.finish_transaction_trace(success=False, error=e.message)
             errors = True
             if self.on_error(e):
                 # real failure
@@ -247,21 +471,10 @@ class Application:
                 self.button_driver_apply.set_sensitive(bool(self.driver_changes))
 
         if installs is None or len(installs) == 0 or errors:
-            if self.needs_broadcom_reload:
-                print("Reloading Broadcom modules")
-                subprocess.call(["sudo", "mintdrivers-load-broadcom-modules"])
-            self.needs_restart = (not errors)
-            self.progress_bar.set_visible(False)
-            self.apt_cache = apt.Cache()
-            self.set_driver_action_status()
-            self.update_label_and_icons_from_status()
-            self.button_driver_revert.set_visible(True)
-            self.button_driver_apply.set_visible(True)
-            self.button_driver_cancel.set_visible(False)
-            self.scrolled_window_drivers.set_sensitive(True)
-            XApp.set_window_progress(self.window_main, 0)
+            self.on_driver_changes_done(errors)
         else:
             print("Installing", installs)
+            self.start_transaction_trace("install", installs)
             self.pk_task.install_packages_async(installs,
                     self.cancellable,  # cancellable
                     self.on_driver_changes_progress,
@@ -270,33 +483,149 @@ class Application:
                     None  # callback data
              )
 
-    def on_driver_changes_apply(self, button):
-        self.pk_task = packagekit.Task()
-        installs = []
-        removals = []
+    def on_driver_changes_done(self, errors):
+        self.account_transaction_time()
+        self.stop_dkms_monitor()
+        if not errors and self.applied_simulation is not None:
+            # The DKMS builds depend on the kernels, not on the size of the packages
+            install_seconds = self.transaction_times.get("install", 0) + self.transaction_times.get("remove", 0)
+            install_seconds = max(0, install_seconds - self.transaction_times.get("dkms", 0))
+            self.transaction_history.record(self.applied_simulation['download'], self.transaction_times.get("download", 0),
+                                            abs(self.applied_simulation['installed_delta']), install_seconds)
+        self.applied_simulation = None
+        if self.needs_broadcom_reload:
+            self.needs_broadcom_reload = False
+            self.jobs.submit("broadcom", self.load_broadcom_modules, None)
+        self.needs_restart = (not errors)
+        self.button_driver_cancel.set_sensitive(False)
+        self.reload_driver_packages_async()
+
+    def load_broadcom_modules(self, cancellable):
+        print("Reloading Broadcom modules")
+        with tracing.tracer.span("broadcom_reload") as span:
+            span.set(return_code=subprocess.call(["sudo", "mintdrivers-load-broadcom-modules"]))
+        return None
 
-        for pkg in self.driver_changes:
-            if pkg.is_installed:
-                removals.append(self.get_package_id(pkg.installed))
-                # The main NVIDIA package is only a metapackage.
-                # We need to collect its dependencies, so that
-                # we can uninstall the driver properly.
-                if 'nvidia' in pkg.shortname:
-                    for dep in self.get_dependencies(self.apt_cache, pkg.shortname, 'nvidia'):
-                        dep_pkg = self.apt_cache[dep]
-                        if dep_pkg.is_installed:
-                            removals.append(self.get_package_id(dep_pkg.installed))
+    @_async
+    def apply_changes_combined(self, removals, installs, fast=False):
+        """ Remove and install the drivers in a single APT transaction """
+        command = ["/usr/bin/pkexec", APPLY_CHANGES_HELPER, "--remove"] + removals + ["--install"] + installs
+        if fast:
+            command.append("--fast")
+        errors = []
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        for line in process.stdout:
+            # See the APT::Status-Fd format
+            elements = line.strip().split(":", 3)
+            if len(elements) != 4:
+                if line.startswith("E: "):
+                    errors.append(line[3:].strip())
+                continue
+            (kind, item, percentage, message) = elements
+            try:
+                percentage = float(percentage)
+            except ValueError:
+                continue
+            if kind == "dlstatus":
+                self.on_combined_changes_progress("download", percentage)
+            elif kind == "pmstatus":
+                self.on_combined_changes_progress("remove" if item.split(":")[0] in removals else "install", percentage)
+            elif kind == "pmerror":
+                errors.append(message)
+        self.on_combined_changes_finish(process.wait(), errors)
+
+    @idle
+    def on_combined_changes_progress(self, status, percentage):
+        self.show_driver_changes_progress(status, int(percentage))
+
+    @idle
+    def on_combined_changes_finish(self, return_code, errors):
+        self.finish_transaction_trace(success=(return_code == 0), return_code=return_code)
+        self.button_driver_cancel.set_sensitive(True)
+        if return_code in (126, 127):
+            # pkexec: the authentication was dismissed or failed
+            self.stop_dkms_monitor()
+            self.progress_bar.set_visible(False)
+            self.button_driver_cancel.set_visible(False)
+            self.button_driver_revert.set_visible(True)
+            self.button_driver_apply.set_visible(True)
+            self.button_driver_revert.set_sensitive(bool(self.driver_changes))
+            self.button_driver_apply.set_sensitive(bool(self.driver_changes))
+            self.scrolled_window_drivers.set_sensitive(True)
+            self.set_driver_action_status()
+            return
+        if return_code != 0:
+            self.show_page("error_page")
+            if len(errors) > 0:
+                self.builder.get_object("error_label").set_label("\n".join(errors))
             else:
-                installs.append(self.get_package_id(pkg.candidate))
-                if pkg.shortname == "broadcom-sta-dkms":
-                    self.needs_broadcom_reload = True
+                self.builder.get_object("error_label").set_label(_("The driver changes could not be applied."))
+            self.on_driver_changes_revert()
+            self.clear_changes()
+        self.on_driver_changes_done(return_code != 0)
+
+    def reload_driver_packages_async(self):
+        self.jobs.submit("reload", self.reload_driver_packages, self.on_driver_packages_reloaded, restart=True)
+
+    def reload_driver_packages(self, cancellable):
+        if self.use_service:
+            import service
+            try:
+                (devices, driver_packages, report) = service.get_state(refresh=True)
+                self.service_refresh = False
+                return (driver_packages, )
+            except GLib.Error as e:
+                print("Could not reach the driver service: %s" % e.message)
+        return (self.cache_manager.reload_driver_packages(), )
+
+    def on_driver_packages_reloaded(self, driver_packages):
+        from gi.repository import XApp
+        self.driver_packages = driver_packages
+        self.progress_bar.set_visible(False)
+        self.set_driver_action_status()
+        self.update_label_and_icons_from_status()
+        self.button_driver_revert.set_visible(True)
+        self.button_driver_apply.set_visible(True)
+        self.button_driver_cancel.set_visible(False)
+        self.button_driver_cancel.set_sensitive(True)
+        self.scrolled_window_drivers.set_sensitive(True)
+        XApp.set_window_progress(self.window_main, 0)
+
+    def on_driver_changes_apply(self, button):
+        from gi.repository import PackageKitGlib as packagekit
+        # The downloaded files stay in the APT cache, the transaction will pick them up
+        self.cancel_prefetch()
+        self.pk_task = packagekit.Task()
+        (install_pkgs, removal_pkgs) = self.get_changes()
+        installs = [pkg.candidate.package_id for pkg in install_pkgs]
+        removals = [pkg.installed.package_id for pkg in removal_pkgs]
+        install_names = [pkg.shortname for pkg in install_pkgs]
+        removal_names = [pkg.shortname for pkg in removal_pkgs]
+        if "broadcom-sta-dkms" in install_names:
+            self.needs_broadcom_reload = True
+        # Measure how long it takes, for the next estimates
+        self.applied_simulation = self.simulation
+        self.transaction_times = {}
+        # Fast apply: only build the DKMS modules for the kernels which matter for the next boot
+        fast = self.settings.get_boolean("fast-apply") and len(installs) > 0 and os.path.exists(APPLY_CHANGES_HELPER)
+        if len(installs) > 0:
+            self.start_dkms_monitor(fast)
 
         self.cancellable = Gio.Cancellable()
         try:
-            if len(removals) > 0:
+            if (len(removals) > 0 and len(installs) > 0 and os.path.exists(APPLY_CHANGES_HELPER)) or fast:
+                # Switching drivers, do it all in one go. APT can't be interrupted safely.
+                # Fast apply needs the helper too, to restrict the DKMS builds.
+                print("Purging", removal_names, "and installing", install_names)
+                self.button_driver_cancel.set_sensitive(False)
+                self.start_transaction_trace("combined", removal_names + install_names, fast=fast)
+                self.show_driver_changes_progress(None)
+                self.apply_changes_combined(removal_names, install_names, fast)
+            elif len(removals) > 0:
                 try:
                     # Try to purge (Mint specific version of packagekit)
                     print("Purging", removals)
+                    self.start_transaction_trace("purge", removals)
                     self.pk_task.purge_packages_async(removals,
                                 False,  # allow deps
                                 True,  # autoremove
@@ -309,6 +638,7 @@ class Application:
                 except:
                     # If purging isn't supported, just remove
                     print("Couldn't purge! Removing", removals)
+                    self.start_transaction_trace("remove", removals)
                     self.pk_task.remove_packages_async(removals,
                                 False,  # allow deps
                                 True,  # autoremove
@@ -320,6 +650,7 @@ class Application:
                      )
             elif len(installs) > 0:
                 print("Installing", installs)
+                self.start_transaction_trace("install", installs)
                 self.pk_task.install_packages_async(installs,
                         self.cancellable,  # cancellable
                         self.on_driver_changes_progress,
@@ -334,6 +665,84 @@ class Application:
         except Exception as e:
             print("Warning: install not completed successfully: {}".format(e))
 
+    def get_changes(self):
+        """ Return the packages to install and the packages to remove """
+        installs = []
+        removals = []
+        for pkg in sorted(self.driver_changes, key=lambda pkg: pkg.shortname):
+            if pkg.is_installed:
+                removals.append(pkg)
+                # The main NVIDIA package is only a metapackage.
+                # We need to collect its dependencies, so that
+                # we can uninstall the driver properly.
+                if 'nvidia' in pkg.shortname:
+                    for dep in drivers.get_dependencies(self.driver_packages, pkg.shortname, 'nvidia'):
+                        dep_pkg = self.driver_packages.get(dep)
+                        if dep_pkg is not None and dep_pkg.is_installed:
+                            removals.append(dep_pkg)
+            else:
+                installs.append(pkg)
+        return (installs, removals)
+
+    def simulate_driver_changes(self):
+        """ Find out what the changes will cost, in the background """
+        (installs, removals) = self.get_changes()
+        self.simulation = None
+        if len(installs) == 0 and len(removals) == 0:
+            self.set_driver_action_status()
+            return
+        self.jobs.submit("simulate", self.simulate, self.on_simulated,
+                         tuple(pkg.shortname for pkg in installs), tuple(pkg.shortname for pkg in removals))
+
+    def simulate(self, cancellable, installs, removals):
+        if self.use_service:
+            # Don't open the full cache in the window, the service has it
+            import service
+            try:
+                return (installs, removals, service.simulate(list(installs), list(removals)))
+            except GLib.Error as e:
+                print("Could not simulate the changes with the driver service: %s" % e.message)
+                return None
+        return (installs, removals, self.cache_manager.simulate(list(installs), list(removals)))
+
+    def on_simulated(self, installs, removals, simulation):
+        (current_installs, current_removals) = self.get_changes()
+        if (installs, removals) != (tuple(pkg.shortname for pkg in current_installs), tuple(pkg.shortname for pkg in current_removals)):
+            # The selection changed in the meantime
+            return
+        if not self.scrolled_window_drivers.get_sensitive():
+            # Already applying
+            return
+        self.simulation = simulation
+        if simulation['broken']:
+            self.label_driver_action.set_label(_("These changes can't be applied, some packages can't be installed."))
+            self.button_driver_apply.set_sensitive(False)
+            return
+        details = []
+        download = GLib.format_size(simulation['download'])
+        if simulation['cached'] > 0:
+            download = _("%(size)s (%(cached)s already downloaded)") % {'size': download, 'cached': GLib.format_size(simulation['cached'])}
+        details.append(_("Download: %s") % download)
+        delta = simulation['installed_delta']
+        details.append(_("Disk space: %s") % ("+" + GLib.format_size(delta) if delta >= 0 else "-" + GLib.format_size(-delta)))
+        duration = self.transaction_history.estimate(simulation['download'], abs(delta))
+        minutes = max(1, round(duration / 60))
+        details.append(gettext.ngettext("About %d minute", "About %d minutes", minutes) % minutes)
+        label = ", ".join(details)
+        if simulation['root_free'] is not None and delta > simulation['root_free']:
+            label = "%s\n%s" % (label, _("There isn't enough disk space to apply these changes."))
+            self.button_driver_apply.set_sensitive(False)
+        elif simulation['boot_free'] is not None and simulation['initrd_size'] > simulation['boot_free']:
+            label = "%s\n%s" % (label, _("There might not be enough space in /boot to update the initramfs images."))
+        self.label_driver_action.set_label(label)
+
+    def account_transaction_time(self):
+        """ Add the time spent in the current status to the transaction times """
+        now = time.monotonic()
+        if self.transaction_status_start is not None and self.transaction_status is not None:
+            self.transaction_times[self.transaction_status] = self.transaction_times.get(self.transaction_status, 0) + now - self.transaction_status_start
+        self.transaction_status_start = now
+
     def on_driver_changes_revert(self, button_revert=None):
 
         # HACK: set all the "Do not use" first; then go through the list of the
@@ -346,6 +755,7 @@ class Application:
             button.set_active(True)
 
         self.clear_changes()
+        self.set_driver_action_status()
 
         self.button_driver_revert.set_sensitive(False)
         self.button_driver_apply.set_sensitive(False)
@@ -360,7 +770,9 @@ class Application:
 
     def clear_changes(self):
         self.orig_selection = {}
-        self.driver_changes = []
+        self.driver_changes = set()
+        self.simulation = None
+        self.cancel_prefetch()
 
     def on_driver_selection_changed(self, button, modalias, pkg_name=None):
         if self.ui_building:
@@ -369,69 +781,84 @@ class Application:
         pkg = None
         try:
             if pkg_name:
-                pkg = self.apt_cache[pkg_name]
+                pkg = self.driver_packages[pkg_name]
         except KeyError:
             pass
 
         if button.get_active():
-            if pkg in self.driver_changes:
-                self.driver_changes.remove(pkg)
+            self.driver_changes.discard(pkg)
 
             if (pkg is not None
                     and modalias in self.orig_selection
                     and button is not self.orig_selection[modalias]):
-                self.driver_changes.append(pkg)
+                self.driver_changes.add(pkg)
         else:
-            if pkg in self.driver_changes:
-                self.driver_changes.remove(pkg)
+            self.driver_changes.discard(pkg)
 
             # for revert; to re-activate the original radio buttons.
             if modalias not in self.orig_selection:
                 self.orig_selection[modalias] = button
 
-            if (pkg is not None
-                    and pkg not in self.driver_changes
-                    and pkg.is_installed):
-                self.driver_changes.append(pkg)
+            if pkg is not None and pkg.is_installed:
+                self.driver_changes.add(pkg)
 
         self.button_driver_revert.set_sensitive(bool(self.driver_changes))
         self.button_driver_apply.set_sensitive(bool(self.driver_changes))
+        self.update_prefetch()
+        self.simulate_driver_changes()
+
+    def update_prefetch(self):
+        """ Download the selected drivers in the background, while the user makes up their mind """
+        from gi.repository import PackageKitGlib as packagekit
+        installs = [pkg for pkg in self.driver_changes if not pkg.is_installed and pkg.candidate is not None]
+        package_ids = sorted(pkg.candidate.package_id for pkg in installs)
+        if package_ids == self.prefetch_package_ids:
+            return
+        self.cancel_prefetch()
+        if len(package_ids) == 0 or not self.settings.get_boolean("prefetch-drivers"):
+            return
+        size = sum(drivers.get_download_size(self.driver_packages, pkg.shortname) for pkg in installs)
+        max_size = self.settings.get_int("prefetch-max-size") * 1024 * 1024
+        if size > max_size:
+            print("Not prefetching %s (%d MB)" % (package_ids, size // (1024 * 1024)))
+            return
+        print("Prefetching", package_ids)
+        self.prefetch_package_ids = package_ids
+        self.prefetch_cancellable = Gio.Cancellable()
+        client = packagekit.Client()
+        # Idle priority, and never prompt the user for a password
+        client.set_background(True)
+        client.set_interactive(False)
+        client.install_packages_async(1 << int(packagekit.TransactionFlagEnum.ONLY_DOWNLOAD),
+                package_ids,
+                self.prefetch_cancellable,  # cancellable
+                self.on_prefetch_progress,
+                (None, ),  # progress data
+                self.on_prefetch_finished,  # GAsyncReadyCallback
+                None  # callback data
+         )
+
+    def cancel_prefetch(self):
+        if self.prefetch_cancellable is not None:
+            self.prefetch_cancellable.cancel()
+            self.prefetch_cancellable = None
+        self.prefetch_package_ids = []
+
+    def on_prefetch_progress(self, progress, ptype, data=None):
+        pass
 
-
-    def get_package_id(self, ver):
-        """ Return the PackageKit package id """
-        assert isinstance(ver, apt.package.Version)
-        return "%s;%s;%s;" % (ver.package.shortname, ver.version, ver.package.architecture())
-
-    @staticmethod
-    def get_dependencies(apt_cache, package_name, pattern=None):
-        """ Get the package dependencies, which can be filtered out by a pattern """
-        dependencies = []
-        for or_group in apt_cache[package_name].candidate.dependencies:
-          for dep in or_group:
-            if dep.rawtype in ["Depends", "PreDepends"]:
-              dependencies.append(dep.name)
-        if pattern:
-          dependencies = [ x for x in dependencies if x.find(pattern) != -1 ]
-        return dependencies
+    def on_prefetch_finished(self, source, result, data=None):
+        try:
+            source.generic_finish(result)
+            print("Prefetch finished")
+        except GLib.Error as e:
+            print("Prefetch stopped: %s" % e.message)
 
     def gather_device_data(self, device):
         """Get various device data used to build the GUI.
 
           return a tuple of (overall_status string, icon, drivers dict).
-          the drivers dict is using this form:
-            {"recommended/alternative": {pkg_name: {
-                                                      'selected': True/False
-                                                      'description': 'description'
-                                                      'builtin': True/False,
-                                                      'free': True/False
-                                                    }
-                                         }}
-             "manually_installed": {"manual": {'selected': True, 'description': description_string}}
-             "no_driver": {"no_driver": {'selected': True/False, 'description': description_string}}
-
-             Please note that either manually_installed and no_driver are set to None if not applicable
-             (no_driver isn't present if there are builtins)
+          See drivers.get_device_data() for the drivers dict.
         """
 
         possible_overall_status = {
@@ -441,170 +868,50 @@ class Application:
             'no_driver': (_("This device is not working."), "disable-device")
         }
 
-        returned_drivers = {'recommended': {}, 'alternative': {}, 'manually_installed': {}, 'no_driver': {}}
-        have_builtin = False
-        one_selected = False
-        try:
-            if device['manual_install']:
-                returned_drivers['manually_installed'] = {True: {'selected': True,
-                                                                 'description': _("Continue using a manually installed driver")}}
-        except KeyError:
-            pass
-
-        """
-        - Never show server drivers.
-        - Pre 560: closed source drivers are recommended. Override any recommended -open drivers with the closed
-          source equivalent.
-        - Post 560 (02/13/2025: open-source drivers are recommended by their devs, and closed source drivers may
-          not be available for a given version.
-        """
-        ignored = []
-
-        for pkg_driver_name in device['drivers']:
-            if not pkg_driver_name.startswith("nvidia-"):
-                continue
-            if pkg_driver_name in ignored:
-                print("Skipping ignored NVIDIA driver '%s'" % pkg_driver_name)
-                continue
-            if pkg_driver_name.endswith(("-server", "-server-open")):
-                print("Ignoring server NVIDIA driver '%s'" % pkg_driver_name)
-                ignored.append(pkg_driver_name)
-                continue
-
-            try:
-                version = int(re.search(r"nvidia-driver-([0-9]{3}).*", pkg_driver_name).groups()[0])
-                open_preferred = version >= 560
-            except:
-                open_preferred = False
-
-            is_open = pkg_driver_name.endswith("-open")
-            current_driver = device['drivers'][pkg_driver_name]
-            recommended = current_driver.get("recommended", False) and current_driver.get("from_distro", False)
-
-            if is_open:
-                closed_name = pkg_driver_name.replace("-open", "")
-                has_closed = closed_name in device['drivers']
-                if has_closed:
-                    if open_preferred:
-                        print("Ignoring closed NVIDIA driver '%s' as the open one is preferred." % closed_name)
-                        ignored.append(closed_name)
-                    else:
-                        print("Ignoring open NVIDIA driver '%s' as a closed one exists and is preferred." % pkg_driver_name)
-                        if recommended:
-                            device['drivers'][closed_name]["recommended"] = True
-                        ignored.append(pkg_driver_name)
-
-        for pkg_driver_name in device['drivers']:
-            if pkg_driver_name in ignored:
-                continue
-            current_driver = device['drivers'][pkg_driver_name]
-
-            # get general status
-            driver_status = 'alternative'
-            try:
-                if (current_driver['recommended'] and current_driver['from_distro']):
-                    driver_status = 'recommended'
-            except KeyError:
-                pass
-
-            builtin = False
-            try:
-                if current_driver['builtin']:
-                    builtin = True
-                    have_builtin = True
-            except KeyError:
-                pass
-
-            try:
-                pkg = self.apt_cache[pkg_driver_name]
-                installed = pkg.is_installed
-                if installed:
-                    version = pkg.installed.version
-                    summary = pkg.installed.summary
-                else:
-                    version = pkg.candidate.version
-                    summary = pkg.candidate.summary
-                description_line1 = "<b>%s</b>" % pkg.shortname
-                description_line2 = "<small>%s</small> %s" % (_("Version"), version)
-                description_line3 = "<small>%s</small>" % summary
-                if driver_status == 'recommended':
-                    description_line1 = "%s <b><small><span foreground='#58822B'>(%s)</span></small></b>" % (description_line1, _("recommended"))
-                if current_driver['free'] and pkg.shortname != "broadcom-sta-dkms" and (not pkg.shortname.startswith("nvidia-")):
-                    description_line1 = "%s <b><small><span foreground='#717bbd'>(%s)</span></small></b>" % (description_line1, _("open-source"))
-                if pkg.shortname.startswith("firmware-b43"):
-                    # B43 requires a connection to the Internet
-                    description_line1 = "%s <b><small><span foreground='#9f5258'>(%s)</span></small></b>" % (description_line1, _("requires a connection to the Internet"))
-                description = "%s\n%s\n%s" % (description_line1, description_line2, description_line3)
-            except KeyError:
-                print("WARNING: a driver ({}) doesn't have any available package associated: {}".format(pkg_driver_name, current_driver))
-                continue
-
-            selected = False
-            if not builtin and not returned_drivers['manually_installed']:
-                selected = installed
-                if installed:
-                    selected = True
-                    one_selected = True
-
-            returned_drivers[driver_status].setdefault(pkg_driver_name, {'selected': selected,
-                                                                         'description': description,
-                                                                         'builtin': builtin,
-                                                                         'free': current_driver['free']})
-
-        # adjust making the needed addition
-        if not have_builtin:
-            selected = False
-            if not one_selected:
-                selected = True
-            returned_drivers["no_driver"] = {True: {'selected': selected,
-                                                    'description': _("Do not use the device")}}
-        else:
-            # we have a builtin and no selection: builtin is the selected one then
-            if not one_selected:
-                for section in ('recommended', 'alternative'):
-                    for pkg_name in returned_drivers[section]:
-                        if returned_drivers[section][pkg_name]['builtin']:
-                            returned_drivers[section][pkg_name]['selected'] = True
-
-        # compute overall status
-        for section in returned_drivers:
-            for keys in returned_drivers[section]:
-                if returned_drivers[section][keys]['selected']:
-                    (overall_status, icon) = possible_overall_status[section]
-
+        with tracing.tracer.span("device_data", modalias=device.get('modalias')) as span:
+            hits = self.device_data_cache.hits
+            (section, returned_drivers) = self.device_data_cache.get_device_data(device, self.driver_packages)
+            span.set(cached=(self.device_data_cache.hits > hits))
+        (overall_status, icon) = possible_overall_status[section]
         return overall_status, icon, returned_drivers
 
     def get_device_icon(self, device):
-        vendor = device.get('vendor', _('Unknown'))
-        model = device.get('model', _('Unknown'))
-        icon = "generic"
-        if "nvidia" in vendor.lower():
-            icon = "nvidia"
-        elif "radeon" in vendor.lower() or "radeon" in model.lower() or "Advanced Micro Devices" in vendor or "AMD" in vendor or "ATI" in vendor:
-            icon = "ati"
-        elif "broadcom" in vendor.lower():
-            icon = "broadcom"
-        elif "virtualbox" in vendor.lower() or "virtualbox" in model.lower():
-            icon = "virtualbox"
-
-        if "intel-microcode" in device['drivers']:
-            icon = "intel"
-        elif "amd64-microcode" in device['drivers']:
-            icon = "amd"
-
-        return GdkPixbuf.Pixbuf.new_from_file_at_size("/usr/share/linuxmint/mintdrivers/icons/%s.svg" % icon, 48, -1)
+        """ Return a cairo surface, so that the icon is sharp on HiDPI displays """
+        from gi.repository import Gdk
+        import icons
+        pixbuf = icons.cache.get_pixbuf(icons.get_icon_name(device), DEVICE_ICON_SIZE, self.scale_factor)
+        return Gdk.cairo_surface_create_from_pixbuf(pixbuf, self.scale_factor, None)
 
     def get_cpu_name(self):
-        with open("/proc/cpuinfo") as cpuinfo:
-            for line in cpuinfo:
-                if "model name" in line:
-                    return re.sub( ".*model name.*:", "", line, 1).strip()
-        return _("Processor")
-
-    @_async
-    def get_drivers_async(self):
-        self.apt_cache = apt.Cache()
-        self.devices = detect.system_device_drivers()
+        if self.cpu_name is None:
+            self.cpu_name = _("Processor")
+            with open("/proc/cpuinfo") as cpuinfo:
+                for line in cpuinfo:
+                    if "model name" in line:
+                        self.cpu_name = re.sub( ".*model name.*:", "", line, 1).strip()
+                        break
+        return self.cpu_name
+
+    def get_drivers_async(self, refreshed=False, restart=False):
+        """ Detect the devices and load their drivers, unless it's already in progress.
+            Use restart when the cache changed, to drop the result of a detection in progress. """
+        self.jobs.submit("detection", self.get_drivers, self.on_drivers_found, refreshed, restart=restart)
+
+    def get_drivers(self, cancellable, refreshed):
+        if self.use_service:
+            try:
+                return self.get_drivers_from_service(refreshed)
+            except GLib.Error as e:
+                print("Could not reach the driver service: %s" % e.message)
+        # The hotplug detection shares the cache, it isn't reopened under either of them
+        with self.cache_manager.hold_cache() as apt_cache:
+            tracing.startup.phase("apt cache")
+            if cancellable.is_cancelled():
+                return None
+            devices = detection.system_device_drivers(apt_cache=apt_cache, use_cache=self.use_detection_cache)
+        tracing.startup.phase("detection")
+        if cancellable.is_cancelled():
+            return None
         if self.test_mode:
             dummy_device = {
                 'modalias': '',
@@ -614,97 +921,278 @@ class Application:
                     'mint-dev-pkg-debconf': {'free': False, 'from_distro': True, 'recommended': False},
                     'linux-generic': {'free': True, 'builtin': True, 'from_distro': True, 'recommended': False}}
                 }
-            self.devices['dummy'] = dummy_device
+            devices['dummy'] = dummy_device
+        driver_packages = self.cache_manager.get_driver_packages(devices)
+        candidates = aptcache.get_driver_candidates(driver_packages, devices)
+        if cancellable.is_cancelled():
+            return None
+        # Rasterize the icons here rather than in the main loop
+        import icons
+        icons.cache.preload(set(icons.get_icon_name(devices[device]) for device in devices), DEVICE_ICON_SIZE, self.scale_factor)
+        tracing.startup.phase("driver packages")
+        return (driver_packages, devices, candidates, refreshed)
+
+    def get_drivers_from_service(self, refreshed):
+        """ The service keeps the cache and the detection warm, we only get the result """
+        import service
+        refresh = self.service_refresh
+        self.service_refresh = False
+        (devices, driver_packages, report) = service.get_state(refresh)
+        tracing.startup.phase("driver service")
+        # So that they can be reloaded after a transaction
+        self.cache_manager.package_names = set(driver_packages)
+        candidates = aptcache.get_driver_candidates(driver_packages, devices)
+        import icons
+        icons.cache.preload(set(icons.get_icon_name(devices[device]) for device in devices), DEVICE_ICON_SIZE, self.scale_factor)
+        return (driver_packages, devices, candidates, refreshed)
+
+    def on_drivers_found(self, driver_packages, devices, candidates, refreshed):
+        if self.cache_refreshed and not refreshed:
+            # The background refresh finished first, this data is outdated
+            return
+        if refreshed:
+            self.cache_refreshed = True
+            if candidates == self.driver_candidates:
+                print("The cache refresh didn't change any driver")
+                return
+            if not self.scrolled_window_drivers.get_sensitive():
+                # Applying, the packages are reloaded afterwards anyway
+                print("The cache refresh changed some drivers, but changes are being applied")
+                return
+            if self.driver_changes:
+                # Don't pull the rug from under the user, keep the selection but
+                # point it to the refreshed packages, so that the new candidates get installed
+                print("The cache refresh changed some drivers, updating the pending changes")
+                self.driver_packages = driver_packages
+                self.driver_candidates = candidates
+                self.driver_changes = set(driver_packages[pkg.shortname] for pkg in self.driver_changes if pkg.shortname in driver_packages)
+                self.button_driver_revert.set_sensitive(bool(self.driver_changes))
+                self.button_driver_apply.set_sensitive(bool(self.driver_changes))
+                self.update_prefetch()
+                self.simulate_driver_changes()
+                return
+            print("The cache refresh changed some drivers, reloading them")
+        self.driver_packages = driver_packages
+        self.devices = devices
+        self.driver_candidates = candidates
         self.show_drivers()
+        if self.device_monitor is None:
+            self.device_monitor = hotplug.DeviceMonitor(self.on_device_hotplugged)
+
+    def on_device_hotplugged(self, action, device_path, modalias):
+        if self.devices is None or not self.scrolled_window_drivers.get_sensitive():
+            # The next detection will pick it up
+            return
+        if action == "add" and modalias and device_path not in self.devices:
+            self.jobs.submit("hotplug:%s" % device_path, self.detect_device, self.on_device_detected, device_path, modalias)
+        elif action == "remove":
+            self.remove_device(device_path)
+
+    def detect_device(self, cancellable, device_path, modalias):
+        """ Only match the new device, the others are already known """
+        if self.use_service:
+            import service
+            try:
+                result = service.detect_device(modalias)
+            except GLib.Error as e:
+                print("Could not detect the new device with the driver service: %s" % e.message)
+                return None
+            if result is None or cancellable.is_cancelled():
+                return None
+            (device, driver_packages) = result
+        else:
+            with self.cache_manager.hold_cache() as apt_cache:
+                device = detection.detect_device(apt_cache, modalias)
+            if device is None or cancellable.is_cancelled():
+                return None
+            driver_packages = self.cache_manager.get_packages(device['drivers'])
+        import icons
+        icons.cache.preload([icons.get_icon_name(device)], DEVICE_ICON_SIZE, self.scale_factor)
+        return (device_path, device, driver_packages)
+
+    def on_device_detected(self, device_path, device, driver_packages):
+        if device_path in self.devices or not self.scrolled_window_drivers.get_sensitive():
+            return
+        print("New device: %s" % drivers.get_device_name(device))
+        self.devices[device_path] = device
+        self.driver_packages.update(driver_packages)
+        self.cache_manager.package_names.update(driver_packages)
+        self.driver_candidates.update(aptcache.get_driver_candidates(driver_packages, {device_path: device}))
+        model = self.get_device_model(device_path)
+        if model is None:
+            return
+        self.ui_building = True
+        row = self.build_device_row(device_path, model)
+        self.device_rows[device_path] = row
+        self.box_driver_detail.reorder_child(row['box'], sorted(self.device_rows).index(device_path))
+        if row['no_driver_button'] is not None:
+            self.no_drv.append(row['no_driver_button'])
+        row['box'].show_all()
+        self.ui_building = False
+        self.show_page("drivers_page")
+        self.set_driver_action_status()
+
+    def remove_device(self, device_path):
+        """ Forget a device which was unplugged, and its children """
+        removed = [device for device in self.devices if device == device_path or device.startswith(device_path + "/")]
+        if len(removed) == 0:
+            return
+        for device in removed:
+            print("Removed device: %s" % drivers.get_device_name(self.devices[device]))
+            for pkg_name in self.devices[device]['drivers']:
+                self.driver_changes.discard(self.driver_packages.get(pkg_name))
+            self.orig_selection.pop(device, None)
+            del self.devices[device]
+            row = self.device_rows.pop(device, None)
+            if row is not None:
+                if row['no_driver_button'] in self.no_drv:
+                    self.no_drv.remove(row['no_driver_button'])
+                row['box'].destroy()
+        if len(self.device_rows) == 0:
+            self.show_page("no_drivers_page")
+        self.button_driver_revert.set_sensitive(bool(self.driver_changes))
+        self.button_driver_apply.set_sensitive(bool(self.driver_changes))
+        self.update_prefetch()
+        self.simulate_driver_changes()
+        self.set_driver_action_status()
+
+    def get_device_model(self, device):
+        """ Return everything needed to show a device, or None if the device should be hidden """
+        (overall_status, icon, device_drivers) = self.gather_device_data(self.devices[device])
+        is_cpu = drivers.is_cpu(self.devices[device])
+        if is_cpu:
+            overall_status = _("Processor microcode")
+            device_name = self.get_cpu_name()
+        else:
+            device_name = drivers.get_device_name(self.devices[device])
+        if drivers.is_virtual_device(device_name):
+            print ("Ignoring device %s" % device_name)
+            return None
+        if device_drivers["manually_installed"]:
+            print("Ignoring device: %s (manually_installed)" % device_name)
+            return None
+
+        # The radio buttons, in the order of introspection, and their state
+        options = []
+        selected = {}
+        for section in ('recommended', 'alternative', 'manually_installed', 'no_driver'):
+            for driver in sorted(device_drivers[section], key=lambda x: drivers.sort_string(device_drivers[section], x), reverse=True):
+                description = device_drivers[section][driver]['description']
+                if section == 'no_driver' and is_cpu:
+                    description = _("Do not update the CPU microcode")
+                if section in ('manually_install', 'no_driver') or ('builtin' in device_drivers[section][driver] and device_drivers[section][driver]['builtin']):
+                    pkg_name = None
+                else:
+                    pkg_name = driver
+                sensitive = not (device_drivers['manually_installed'] and section != 'manually_installed' and "firmware" not in str(driver))
+                options.append((section, driver, pkg_name, description, sensitive))
+                selected[(section, driver)] = device_drivers[section][driver]['selected']
+
+        return {'name': device_name,
+                'status': overall_status,
+                'icon': icon,
+                'options': options,
+                'selected': selected}
+
+    def build_device_row(self, device, model):
+        row = {'model': model, 'buttons': {}, 'no_driver_button': None}
+        brand_icon = Gtk.Image()
+        brand_icon.set_valign(Gtk.Align.START)
+        brand_icon.set_halign(Gtk.Align.CENTER)
+        brand_icon.set_from_surface(self.get_device_icon(self.devices[device]))
+        row['status_icon'] = Gtk.Image()
+        row['status_icon'].set_valign(Gtk.Align.START)
+        row['status_icon'].set_halign(Gtk.Align.CENTER)
+        row['status_icon'].set_from_icon_name(model['icon'], Gtk.IconSize.MENU)
+        row['box'] = Gtk.Box(spacing=6, orientation=Gtk.Orientation.HORIZONTAL)
+        row['box'].pack_start(brand_icon, False, False, 6)
+        device_detail = Gtk.Box(spacing=6, orientation=Gtk.Orientation.VERTICAL)
+        row['box'].pack_start(device_detail, True, True, 0)
+        widget = Gtk.Label(label=model['name'])
+        widget.set_halign(Gtk.Align.START)
+        device_detail.pack_start(widget, True, False, 0)
+        row['status_label'] = Gtk.Label(label="<small>{}</small>".format(model['status']))
+        row['status_label'].set_halign(Gtk.Align.START)
+        row['status_label'].set_use_markup(True)
+        device_detail.pack_start(row['status_label'], True, False, 0)
+
+        option_group = None
+        for (section, driver, pkg_name, description, sensitive) in model['options']:
+            radio_button = Gtk.RadioButton.new(None)
+            label = Gtk.Label()
+            label.set_markup(description)
+            radio_button.add(label)
+            if option_group:
+                radio_button.join_group(option_group)
+            else:
+                option_group = radio_button
+            device_detail.pack_start(radio_button, True, False, 0)
+            radio_button.set_active(model['selected'][(section, driver)])
+            if section == 'no_driver':
+                row['no_driver_button'] = radio_button
+            if pkg_name is None:
+                radio_button.connect("toggled", self.on_driver_selection_changed, device)
+            else:
+                radio_button.connect("toggled", self.on_driver_selection_changed, device, pkg_name)
+            radio_button.set_sensitive(sensitive)
+            row['buttons'][(section, driver)] = radio_button
+
+        self.box_driver_detail.pack_start(row['box'], False, False, 6)
+        return row
+
+    def update_device_row(self, row, model, status_only=False):
+        """ Only touch the widgets whose state changed """
+        old_model = row['model']
+        if model['icon'] != old_model['icon']:
+            row['status_icon'].set_from_icon_name(model['icon'], Gtk.IconSize.MENU)
+        if model['status'] != old_model['status']:
+            row['status_label'].set_label("<small>{}</small>".format(model['status']))
+        if not status_only:
+            for key in model['selected']:
+                if model['selected'][key] and not row['buttons'][key].get_active():
+                    row['buttons'][key].set_active(True)
+        row['model'] = model
 
-    @idle
     def show_drivers(self):
-        self.driver_changes = []
+        """ Build the list of devices, or update it in place if it's already shown """
+        self.driver_changes = set()
         self.orig_selection = {}
+        self.nonfree_drivers = 0
+        self.ui_building = True
+        span = tracing.tracer.span("show_drivers")
+        (built, updated) = (0, 0)
+        drivers_found = False
+        shown_devices = []
+        for device in sorted(self.devices.keys()):
+            model = self.get_device_model(device)
+            if model is None:
+                continue
+            drivers_found = True
+            row = self.device_rows.get(device)
+            if row is not None and row['model']['options'] == model['options']:
+                self.update_device_row(row, model)
+                updated += 1
+            else:
+                # New device, or its drivers changed
+                if row is not None:
+                    row['box'].destroy()
+                row = self.build_device_row(device, model)
+                self.device_rows[device] = row
+                built += 1
+            self.box_driver_detail.reorder_child(row['box'], len(shown_devices))
+            shown_devices.append(device)
+
+        for device in list(self.device_rows.keys()):
+            if device not in shown_devices:
+                self.device_rows[device]['box'].destroy()
+                del self.device_rows[device]
+
         # HACK: the case where the selection is actually "Do not use"; is a little
         #       tricky to implement because you can't check for whether a package is
         #       installed or any such thing. So let's keep a list of all the
         #       "Do not use" radios, set those active first, then iterate through
         #       orig_selection when doing a Reset.
-        self.no_drv = []
-        self.nonfree_drivers = 0
-        self.ui_building = True
-        self.dynamic_device_status = {}
-        drivers_found = False
-        if len(self.devices) != 0:
-            for device in sorted(self.devices.keys()):
-                (overall_status, icon, drivers) = self.gather_device_data(self.devices[device])
-                is_cpu = False
-                if "intel-microcode" in self.devices[device]['drivers'] or "amd64-microcode" in self.devices[device]['drivers']:
-                    is_cpu = True
-                    overall_status = _("Processor microcode")
-                brand_icon = Gtk.Image()
-                brand_icon.set_valign(Gtk.Align.START)
-                brand_icon.set_halign(Gtk.Align.CENTER)
-                brand_icon.set_from_pixbuf(self.get_device_icon(self.devices[device]))
-                driver_status = Gtk.Image()
-                driver_status.set_valign(Gtk.Align.START)
-                driver_status.set_halign(Gtk.Align.CENTER)
-                driver_status.set_from_icon_name(icon, Gtk.IconSize.MENU)
-                device_box = Gtk.Box(spacing=6, orientation=Gtk.Orientation.HORIZONTAL)
-                device_box.pack_start(brand_icon, False, False, 6)
-                device_detail = Gtk.Box(spacing=6, orientation=Gtk.Orientation.VERTICAL)
-                device_box.pack_start(device_detail, True, True, 0)
-                model_name = self.devices[device].get('model', None)
-                vendor_name = self.devices[device].get('vendor', None)
-                if is_cpu:
-                    device_name = self.get_cpu_name()
-                elif vendor_name is None and model_name is None:
-                    device_name = _("Unknown")
-                elif vendor_name is None:
-                    device_name = model_name
-                elif model_name is None:
-                    device_name = vendor_name
-                else:
-                    device_name = "%s: %s" % (vendor_name, model_name)
-                if "vmware" in device_name.lower() or "virtualbox" in device_name.lower():
-                    print ("Ignoring device %s" % device_name)
-                    continue
-                if drivers["manually_installed"]:
-                    print("Ignoring device: %s (manually_installed)" % device_name)
-                    continue
-                drivers_found = True
-                widget = Gtk.Label(label=device_name)
-                widget.set_halign(Gtk.Align.START)
-                device_detail.pack_start(widget, True, False, 0)
-                widget = Gtk.Label(label="<small>{}</small>".format(overall_status))
-                widget.set_halign(Gtk.Align.START)
-                widget.set_use_markup(True)
-                device_detail.pack_start(widget, True, False, 0)
-                self.dynamic_device_status[device] = (driver_status, widget)
-
-                option_group = None
-                # define the order of introspection
-                for section in ('recommended', 'alternative', 'manually_installed', 'no_driver'):
-                    for driver in sorted(drivers[section], key=lambda x: self.sort_string(drivers[section], x), reverse=True):
-                        radio_button = Gtk.RadioButton.new(None)
-                        label = Gtk.Label()
-                        label.set_markup(drivers[section][driver]['description'])
-                        radio_button.add(label)
-                        if option_group:
-                            radio_button.join_group(option_group)
-                        else:
-                            option_group = radio_button
-                        device_detail.pack_start(radio_button, True, False, 0)
-                        radio_button.set_active(drivers[section][driver]['selected'])
-
-                        if section == 'no_driver':
-                            self.no_drv.append(radio_button)
-                            if is_cpu:
-                                label.set_markup(_("Do not update the CPU microcode"))
-                        if section in ('manually_install', 'no_driver') or ('builtin' in drivers[section][driver] and drivers[section][driver]['builtin']):
-                            radio_button.connect("toggled", self.on_driver_selection_changed, device)
-                        else:
-                            radio_button.connect("toggled", self.on_driver_selection_changed, device, driver)
-                        if drivers['manually_installed'] and section != 'manually_installed' and "firmware" not in str(driver):
-                            radio_button.set_sensitive(False)
-
-                self.box_driver_detail.pack_start(device_box, False, False, 6)
+        self.no_drv = [row['no_driver_button'] for row in self.device_rows.values() if row['no_driver_button'] is not None]
 
         if drivers_found:
             self.show_page("drivers_page")
@@ -715,24 +1203,17 @@ class Application:
         self.ui_building = False
         self.box_driver_detail.show_all()
         self.set_driver_action_status()
-
-    def sort_string(self, drivers, x):
-        value = x
-        try:
-            value = "%s %s" % (not drivers[x]['free'], value)
-        except:
-            pass #best effort (some driver options don't have a 'free' flag, and that's alright)
-        return value
+        span.finish(built=built, updated=updated, **self.device_data_cache.get_stats())
+        tracing.startup.phase("drivers shown")
 
     def update_label_and_icons_from_status(self):
         """Update the current label and icon, computing the new device status"""
 
         for device in self.devices:
-            if device in self.dynamic_device_status.keys():
-                (overall_status, icon, drivers) = self.gather_device_data(self.devices[device])
-                (driver_status, widget) = self.dynamic_device_status[device]
-                driver_status.set_from_icon_name(icon, Gtk.IconSize.MENU)
-                widget.set_label("<small>{}</small>".format(overall_status))
+            if device in self.device_rows:
+                model = self.get_device_model(device)
+                if model is not None:
+                    self.update_device_row(self.device_rows[device], model, status_only=True)
 
     def set_driver_action_status(self):
         # Update the label in case we end up having some kind of proprietary driver in use.
@@ -742,12 +1223,7 @@ class Application:
             self.window_main.set_urgency_hint(True)
             return
 
-        self.nonfree_drivers = 0
-        for device in self.devices:
-            for pkg_name in self.devices[device]['drivers']:
-                pkg = self.apt_cache[pkg_name]
-                if (not self.devices[device]['drivers'][pkg_name]['free'] or pkg_name == "broadcom-sta-dkms") and pkg.is_installed:
-                    self.nonfree_drivers = self.nonfree_drivers + 1
+        self.nonfree_drivers = drivers.count_proprietary_drivers(self.devices, self.driver_packages)
 
         if self.nonfree_drivers > 0:
             self.label_driver_action.set_label(gettext.ngettext(
@@ -759,5 +1235,22 @@ class Application:
             self.label_driver_action.set_label(_("No proprietary drivers are in use."))
 
 if __name__ == "__main__":
-    Application()
+    parser = argparse.ArgumentParser(description=_("Driver Manager"))
+    parser.add_argument("mode", nargs="?", choices=["test"], help="add a dummy device, for testing purposes")
+    parser.add_argument("--no-cache", action="store_true", help="don't use the cached driver detection")
+    args = parser.parse_args()
+    # Only one instance, a second launch brings the first one forward
+    unique_app = Gtk.Application(application_id="com.linuxmint.mintdrivers")
+    try:
+        unique_app.register(None)
+        if unique_app.get_is_remote():
+            print("Driver Manager is already running")
+            unique_app.activate()
+            # The remote activation is an async D-Bus call, send it before exiting
+            unique_app.get_dbus_connection().flush_sync(None)
+            sys.exit(0)
+    except GLib.Error as e:
+        print("Could not check for another instance: %s" % e.message)
+    application = Application(args)
+    unique_app.connect("activate", lambda app: application.window_main.present())
     Gtk.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+import time
+
+from gi.repository import GLib
+
+# Renders per second, anything more is wasted on redrawing
+FRAME_RATE = 10
+# Minimum interval between two download speed samples, in seconds
+SPEED_SAMPLE_INTERVAL = 0.5
+# Weight of the latest sample in the average download speed
+SPEED_SMOOTHING = 0.3
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%d:%02d:%02d" % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+    return "%d:%02d" % (seconds // 60, seconds % 60)
+
+class ProgressAggregator:
+    """ Collects the progress of a transaction, which PackageKit can report hundreds
+        of times per second, and renders it at most FRAME_RATE times per second,
+        only when something changed. The download speed and the time left are
+        computed from the remaining bytes.
+
+        render(state, changed, first) is called from the main loop, with the state
+        (status, percentage, speed, eta, build), the names of the fields which changed
+        since the last render, and whether it's the first render since reset(). """
+
+    def __init__(self, render):
+        self.render = render
+        self.source_id = None
+        self.reset()
+
+    def reset(self):
+        if self.source_id is not None:
+            GLib.source_remove(self.source_id)
+            self.source_id = None
+        self.state = {'status': None, 'percentage': None, 'speed': None, 'eta': None, 'build': None}
+        self.rendered = None
+        self.last_sample = None
+
+    def set_status(self, status):
+        self.set('status', status)
+
+    def set_percentage(self, percentage):
+        self.set('percentage', percentage)
+
+    def set_build(self, build):
+        """ The DKMS build in progress, if any: (module, kernel, index, total, elapsed, percentage) """
+        self.set('build', build)
+
+    def set_remaining(self, remaining):
+        """ The number of bytes left to download """
+        now = time.monotonic()
+        if self.last_sample is not None:
+            (last_time, last_remaining) = self.last_sample
+            elapsed = now - last_time
+            if elapsed < SPEED_SAMPLE_INTERVAL:
+                return
+            if remaining <= last_remaining:
+                speed = (last_remaining - remaining) / elapsed
+                if self.state['speed'] is not None:
+                    speed = SPEED_SMOOTHING * speed + (1 - SPEED_SMOOTHING) * self.state['speed']
+                self.set('speed', speed)
+                self.set('eta', remaining / speed if speed > 0 else None)
+        self.last_sample = (now, remaining)
+
+    def set(self, name, value):
+        self.state[name] = value
+        if self.source_id is None:
+            self.source_id = GLib.timeout_add(1000 // FRAME_RATE, self.flush)
+
+    def flush(self):
+        self.source_id = None
+        first = self.rendered is None
+        rendered = self.rendered or {}
+        changed = set(name for name in self.state if first or rendered[name] != self.state[name])
+        if len(changed) > 0:
+            self.rendered = dict(self.state)
+            self.render(self.state, changed, first)
+        return False
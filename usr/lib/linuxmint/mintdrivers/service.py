@@ -0,0 +1,227 @@
+#!/usr/bin/python3
+
+import json
+import sys
+
+from gi.repository import Gio, GLib
+
+import aptcache
+import detection
+import drivers
+import jobs
+import tracing
+
+# The driver service runs on the session bus, and is started on demand (D-Bus activation).
+# It keeps the APT cache and the detected devices warm, refreshes them in the background
+# when the package lists or the dpkg status change, and serves them to the GUI and the
+# command line, which then don't need to open the cache or detect anything themselves.
+# It also detects the devices which are plugged in, and simulates the changes, for the GUI.
+
+BUS_NAME = "com.linuxmint.mintdrivers.Service"
+OBJECT_PATH = "/com/linuxmint/mintdrivers/Service"
+INTERFACE = "com.linuxmint.mintdrivers.Service"
+ERROR = "com.linuxmint.mintdrivers.Service.Error"
+
+INTROSPECTION = """
+<node>
+  <interface name="com.linuxmint.mintdrivers.Service">
+    <method name="GetState">
+      <arg type="b" name="refresh" direction="in"/>
+      <arg type="s" name="state" direction="out"/>
+    </method>
+    <method name="DetectDevice">
+      <arg type="s" name="modalias" direction="in"/>
+      <arg type="s" name="device" direction="out"/>
+    </method>
+    <method name="Simulate">
+      <arg type="as" name="installs" direction="in"/>
+      <arg type="as" name="removals" direction="in"/>
+      <arg type="s" name="simulation" direction="out"/>
+    </method>
+    <signal name="Changed"/>
+  </interface>
+</node>
+"""
+
+# Wait for the package manager to be done before refreshing, in seconds
+REFRESH_DELAY = 2
+# A detection can take a while when the cache is cold, in milliseconds
+CALL_TIMEOUT = 5 * 60 * 1000
+
+WATCHED_DIRECTORIES = ["/var/lib/dpkg", aptcache.APT_LISTS_DIR]
+
+def call(method, parameters):
+    """ Client side: call a method of the service and return its JSON result.
+        Raises GLib.Error if the service isn't available. """
+    connection = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+    result = connection.call_sync(BUS_NAME, OBJECT_PATH, INTERFACE, method,
+                                  parameters, GLib.VariantType("(s)"),
+                                  Gio.DBusCallFlags.NONE, CALL_TIMEOUT, None)
+    return json.loads(result.unpack()[0])
+
+def get_packages(data):
+    driver_packages = {}
+    for name in data:
+        driver_packages[name] = aptcache.DriverPackage.from_dict(data[name])
+    return driver_packages
+
+def get_state(refresh=False):
+    """ Client side: return the devices, the driver packages and the report from the service """
+    state = call("GetState", GLib.Variant("(b)", (refresh, )))
+    return (state['devices'], get_packages(state['packages']), state['report'])
+
+def detect_device(modalias):
+    """ Client side: return the device and its driver packages, or None if it doesn't need any driver """
+    result = call("DetectDevice", GLib.Variant("(s)", (modalias, )))
+    if result is None:
+        return None
+    return (result['device'], get_packages(result['packages']))
+
+def simulate(installs, removals):
+    """ Client side: see CacheManager.simulate() """
+    return call("Simulate", GLib.Variant("(asas)", (installs, removals)))
+
+class Service:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.cache_manager = aptcache.CacheManager()
+        self.jobs = jobs.JobScheduler()
+        self.state = None
+        self.stale = True
+        self.waiting = []
+        self.refresh_source_id = None
+        self.calls = 0
+        self.connection = None
+        self.monitors = []
+        for path in WATCHED_DIRECTORIES:
+            monitor = Gio.File.new_for_path(path).monitor_directory(Gio.FileMonitorFlags.NONE, None)
+            monitor.connect("changed", self.on_files_changed)
+            self.monitors.append(monitor)
+        node = Gio.DBusNodeInfo.new_for_xml(INTROSPECTION)
+        self.interface = node.interfaces[0]
+        Gio.bus_own_name(Gio.BusType.SESSION, BUS_NAME, Gio.BusNameOwnerFlags.NONE,
+                         self.on_bus_acquired, None, self.on_name_lost)
+
+    def on_bus_acquired(self, connection, name):
+        self.connection = connection
+        connection.register_object(OBJECT_PATH, self.interface, self.on_method_call, None, None)
+        # Warm up straight away
+        self.refresh()
+
+    def on_name_lost(self, connection, name):
+        print("Could not own %s, is the service already running?" % BUS_NAME)
+        self.loop.quit()
+
+    def on_method_call(self, connection, sender, object_path, interface_name, method_name, parameters, invocation):
+        if method_name == "DetectDevice":
+            self.reply_async(invocation, self.detect_device, *parameters.unpack())
+            return
+        if method_name == "Simulate":
+            self.reply_async(invocation, self.cache_manager.simulate, *parameters.unpack())
+            return
+        if method_name != "GetState":
+            invocation.return_dbus_error("org.freedesktop.DBus.Error.UnknownMethod", method_name)
+            return
+        (refresh, ) = parameters.unpack()
+        if refresh:
+            self.cache_manager.invalidate()
+            self.stale = True
+        if self.state is not None and not self.stale:
+            invocation.return_value(GLib.Variant("(s)", (self.state, )))
+            return
+        # Answered once the state is up to date
+        self.waiting.append(invocation)
+        self.refresh()
+
+    def reply_async(self, invocation, function, *args):
+        """ Answer a method call with the result of function(*args), computed in the background """
+        # A job per call, so that identical calls are all answered
+        self.calls += 1
+        self.jobs.submit("call:%d" % self.calls, self.get_reply, self.on_reply, invocation, function, args)
+
+    def get_reply(self, cancellable, invocation, function, args):
+        try:
+            return (invocation, json.dumps(function(*args)), None)
+        except Exception as e:
+            return (invocation, None, str(e))
+
+    def on_reply(self, invocation, reply, error):
+        if error is not None:
+            invocation.return_dbus_error(ERROR, error)
+        else:
+            invocation.return_value(GLib.Variant("(s)", (reply, )))
+
+    def detect_device(self, modalias):
+        with self.cache_manager.hold_cache() as apt_cache:
+            device = detection.detect_device(apt_cache, modalias)
+        if device is None:
+            return None
+        packages = self.cache_manager.get_packages(device['drivers'])
+        return {'device': device, 'packages': {name: packages[name].to_dict() for name in packages}}
+
+    def on_files_changed(self, monitor, file, other_file, event_type):
+        if event_type not in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED,
+                              Gio.FileMonitorEvent.DELETED, Gio.FileMonitorEvent.MOVED_IN):
+            return
+        # Lock files and partial downloads don't count
+        if file.get_basename() in ("lock", "lock-frontend", "partial"):
+            return
+        self.cache_manager.invalidate()
+        self.stale = True
+        # Many files change during an update or a transaction, refresh once it settles
+        if self.refresh_source_id is not None:
+            GLib.source_remove(self.refresh_source_id)
+        self.refresh_source_id = GLib.timeout_add_seconds(REFRESH_DELAY, self.on_refresh_timeout)
+
+    def on_refresh_timeout(self):
+        self.refresh_source_id = None
+        self.refresh()
+        return False
+
+    def refresh(self):
+        if self.jobs.is_running("detection"):
+            # on_state_ready() refreshes again if anything changed in the meantime
+            return
+        self.stale = False
+        self.jobs.submit("detection", self.get_state, self.on_state_ready)
+
+    def get_state(self, cancellable):
+        with tracing.tracer.span("service_refresh") as span:
+            try:
+                with self.cache_manager.hold_cache() as apt_cache:
+                    devices = detection.system_device_drivers(apt_cache=apt_cache)
+                driver_packages = self.cache_manager.get_driver_packages(devices)
+                report = drivers.make_report(devices, driver_packages)
+            except Exception as e:
+                span.set(error=str(e))
+                return (None, str(e))
+            packages = {}
+            for name in driver_packages:
+                packages[name] = driver_packages[name].to_dict()
+            return (json.dumps({'devices': devices, 'packages': packages, 'report': report}), None)
+
+    def on_state_ready(self, state, error):
+        if error is not None:
+            print("Could not detect the drivers: %s" % error)
+            for invocation in self.waiting:
+                invocation.return_dbus_error(ERROR, error)
+            self.waiting = []
+            return
+        changed = state != self.state
+        self.state = state
+        if self.stale:
+            # Something changed while we were busy
+            self.refresh()
+            return
+        for invocation in self.waiting:
+            invocation.return_value(GLib.Variant("(s)", (state, )))
+        self.waiting = []
+        if changed and self.connection is not None:
+            self.connection.emit_signal(None, OBJECT_PATH, INTERFACE, "Changed", None)
+
+if __name__ == "__main__":
+    loop = GLib.MainLoop()
+    Service(loop)
+    loop.run()
+    sys.exit(0)
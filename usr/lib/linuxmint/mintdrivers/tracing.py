@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+import json
+import os
+import sys
+import threading
+import time
+
+class Span:
+    """ Measures the duration of a phase. Use it as a context manager,
+        or call finish() when the phase ends in a callback. """
+
+    def __init__(self, tracer, name, fields):
+        self.tracer = tracer
+        self.name = name
+        self.fields = fields
+        self.start = time.monotonic()
+        self.finished = False
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def finish(self, **fields):
+        if self.finished:
+            return
+        self.finished = True
+        self.fields.update(fields)
+        self.tracer.emit(self.name, duration_ms=round((time.monotonic() - self.start) * 1000, 3), **self.fields)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.fields["error"] = exc_type.__name__
+        self.finish()
+        return False
+
+class NullSpan:
+    """ Used when tracing is disabled, so that it costs next to nothing """
+
+    def set(self, **fields):
+        pass
+
+    def finish(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class Tracer:
+    """ Records the duration of each phase (detection, cache, rendering, transactions..)
+        as JSON lines. Set MINTDRIVERS_TRACE to a file path, to "-" for stderr,
+        or to "journal" to send them to the systemd journal. """
+
+    def __init__(self):
+        self.target = os.environ.get("MINTDRIVERS_TRACE")
+        self.enabled = bool(self.target)
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.journal = None
+        self.output = None
+        if self.target == "journal":
+            try:
+                from systemd import journal
+                self.journal = journal
+            except ImportError:
+                print("python3-systemd is not installed, tracing to stderr instead", file=sys.stderr)
+                self.target = "-"
+        if self.target == "-":
+            self.output = sys.stderr
+        elif self.enabled and self.journal is None:
+            try:
+                self.output = open(self.target, "a", buffering=1)
+            except OSError as e:
+                print("Could not open trace file %s: %s" % (self.target, e), file=sys.stderr)
+                self.enabled = False
+
+    def span(self, name, **fields):
+        if not self.enabled:
+            return NullSpan()
+        return Span(self, name, fields)
+
+    def count(self, name, value=1):
+        """ Increment a counter, the counters are added to every record which follows """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def emit(self, event, **fields):
+        if not self.enabled:
+            return
+        record = {"time": round(time.time(), 6), "pid": os.getpid(), "event": event}
+        record.update(fields)
+        with self.lock:
+            if self.counts:
+                record["counts"] = dict(self.counts)
+            if self.journal is not None:
+                self.journal.send(json.dumps(record), SYSLOG_IDENTIFIER="mintdrivers", MINTDRIVERS_EVENT=event)
+            else:
+                self.output.write(json.dumps(record) + "\n")
+
+class StartupTrace:
+    """ Prints how long each startup phase took, when MINTDRIVERS_TRACE_STARTUP=1 """
+
+    def __init__(self):
+        self.enabled = os.environ.get("MINTDRIVERS_TRACE_STARTUP") == "1"
+        self.start = time.monotonic()
+        self.last = self.start
+        self.done = set()
+
+    def phase(self, name):
+        """ Mark the end of a phase, phases are only reported once """
+        if name in self.done or not (self.enabled or tracer.enabled):
+            return
+        now = time.monotonic()
+        self.done.add(name)
+        if self.enabled:
+            print("[startup] %-20s %8.1f ms  (total %8.1f ms)" % (name, (now - self.last) * 1000, (now - self.start) * 1000), file=sys.stderr)
+        tracer.emit("startup", phase=name, duration_ms=round((now - self.last) * 1000, 3), total_ms=round((now - self.start) * 1000, 3))
+        self.last = now
+
+tracer = Tracer()
+startup = StartupTrace()